@@ -0,0 +1,90 @@
+# Scripted user flows driving run.py through streamlit's AppTest, shared by the benchmarks and the load test.
+# Every step is one script run; it records the wall time of the run and the backend calls it caused, including
+# the ones its background tasks make after the run (the step only ends once the backend is idle).
+import os
+import time
+
+from streamlit.testing.v1 import AppTest
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'run.py')
+
+# Raised when a script run ends with an exception or an error message on the page
+class FlowError(Exception):
+    pass
+
+# One simulated user: an AppTest session of run.py, timing every step against the stand-in backend
+class AppDriver:
+    def __init__(self, backend, timeout=60):
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.backend = backend
+        self.samples = []
+
+    def step(self, name, action=None):
+        calls_before = self.backend.call_count()
+        started = time.perf_counter()
+        (action or self.at.run)()
+        elapsed = time.perf_counter() - started
+        if not self.backend.wait_idle():
+            raise FlowError(f'{name}: background backend calls still running after the step')
+        if self.at.exception:
+            raise FlowError(f'{name}: {self.at.exception[0].message}')
+        errors = [error.value for error in self.at.error]
+        if errors:
+            raise FlowError(f'{name}: {errors[0]}')
+        self.samples.append({'step': name, 'ms': elapsed * 1000, 'calls': self.backend.call_count() - calls_before})
+
+    def widget(self, kind, label):
+        for element in getattr(self.at, kind):
+            if element.label == label:
+                return element
+        raise FlowError(f'no {kind} labelled {label!r} on the page')
+
+    def click(self, label):
+        return lambda: self.widget('button', label).click().run()
+
+# Function to open the app and log in
+def login(driver, username='bench'):
+    driver.step('first_paint')
+    driver.at.text_input(key='login').input(username)
+    driver.at.text_input(key='password').input('password')
+    driver.step('login', driver.click('Login'))
+
+# Function to log in and open the first session listed in the sidebar
+def open_session(driver, username='bench'):
+    login(driver, username)
+    sessions = [button for button in driver.at.sidebar.button if button.label.startswith('Session ')]
+    if not sessions:
+        raise FlowError('open_session: no sessions listed in the sidebar')
+    driver.step('open_session', lambda: sessions[0].click().run())
+
+def flow_login(driver):
+    login(driver)
+
+# Opening a session, then reruns with nothing changed (the cost of any widget interaction)
+def flow_session(driver):
+    open_session(driver)
+    for _ in range(3):
+        driver.step('rerun')
+
+def flow_location(driver):
+    open_session(driver)
+    driver.widget('number_input', 'Longitude').set_value(3.0)
+    driver.widget('number_input', 'Latitude').set_value(36.0)
+    driver.step('query_location', driver.click('Query Location'))
+    places = driver.widget('selectbox', 'Select a place')
+    if len(places.options) > 1:
+        places.set_value(places.options[1])
+    driver.step('query_place', driver.click('Query Place'))
+
+def flow_chat(driver):
+    open_session(driver)
+    for index in range(3):
+        driver.widget('text_input', 'Type your message').input(f'Where should I go next? ({index})')
+        driver.step('chat', driver.click('Send'))
+
+FLOWS = {
+    'login': flow_login,
+    'session': flow_session,
+    'location': flow_location,
+    'chat': flow_chat,
+}
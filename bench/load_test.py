@@ -0,0 +1,327 @@
+# Load test of one `streamlit run run.py` server against the local stand-in backend.
+# Starts the stand-in backend and a headless streamlit server, then for every user count opens that many
+# concurrent browser-like sessions over streamlit's websocket protocol. Every simulated user logs in,
+# opens a session and keeps sending a random mix of chat messages, location/place queries and plain
+# reruns for a fixed time. Reports throughput, latency percentiles, errors, and the thread count, CPU and
+# memory of the server process, so the user count where throughput stops growing shows where the
+# synchronous backend calls on the script threads saturate the process.
+#
+#     python bench/load_test.py --users 1,2,4,8,16 --duration 30 --latency 200 --latency-for query_ai=1500
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+import requests
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from websockets.sync.client import connect
+
+from flows import APP_PATH, FlowError
+from mock_backend import add_mock_arguments, mock_config_from_args, start_mock_backend
+
+ACTIONS = ('chat', 'location', 'rerun')
+# Throughput gains below this share when users are doubled mean the process is saturated
+SATURATION_GAIN = 0.1
+SERVER_START_SECONDS = 60
+
+# A browser session of the app reduced to the wire protocol: sends script reruns with widget values,
+# and collects the widgets the app renders so later actions can find them by label
+class StreamlitClient:
+    def __init__(self, ws, timeout):
+        self.ws = ws
+        self.timeout = timeout
+        self.widgets = {}  # delta path -> (label, widget id, fragment id, options)
+        self.values = {}  # widget id -> WidgetState sent with every rerun, like the browser keeps them
+        self.samples = []
+
+    def find(self, label, prefix=False):
+        for widget in self.widgets.values():
+            if widget[0] == label or (prefix and widget[0].startswith(label)):
+                return widget
+        raise FlowError(f'no widget labelled {label!r} on the page')
+
+    def set_value(self, label, **value):
+        widget_id = self.find(label)[1]
+        self.values[widget_id] = WidgetState(id=widget_id, **value)
+
+    # Sends one rerun (optionally clicking a button) and waits until the script run, and any rerun it
+    # requested, has finished. Records the wall time as a sample of `step`.
+    def rerun(self, step, click=None, prefix=False):
+        message = BackMsg()
+        message.rerun_script.query_string = ''
+        message.rerun_script.page_script_hash = ''
+        message.rerun_script.widget_states.widgets.extend(self.values.values())
+        if click is not None:
+            _, widget_id, fragment_id, _ = self.find(click, prefix)
+            message.rerun_script.widget_states.widgets.append(WidgetState(id=widget_id, trigger_value=True))
+            if fragment_id:
+                message.rerun_script.fragment_id = fragment_id
+        started = time.perf_counter()
+        self.ws.send(message.SerializeToString())
+        errors = []
+        while True:
+            forward = ForwardMsg()
+            forward.ParseFromString(self.ws.recv(timeout=self.timeout))
+            kind = forward.WhichOneof('type')
+            if kind == 'new_session' and not forward.new_session.fragment_ids_this_run:
+                self.widgets.clear()
+            elif kind == 'delta' and forward.delta.WhichOneof('type') == 'new_element':
+                self.collect(forward, errors)
+            elif kind == 'script_finished' and forward.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                break
+        self.samples.append({'step': step, 'ms': (time.perf_counter() - started) * 1000})
+        if errors:
+            raise FlowError(f'{step}: {errors[0]}')
+
+    def collect(self, forward, errors):
+        element = forward.delta.new_element
+        kind = element.WhichOneof('type')
+        if kind == 'exception':
+            errors.append(element.exception.message)
+        elif kind == 'alert' and element.alert.format == element.alert.ERROR:
+            errors.append(element.alert.body)
+        widget = getattr(element, kind) if kind else None
+        if widget is not None and hasattr(widget, 'id') and hasattr(widget, 'label') and widget.id:
+            self.widgets[tuple(forward.metadata.delta_path)] = (
+                widget.label, widget.id, forward.delta.fragment_id, list(getattr(widget, 'options', [])))
+
+# Function to log in and open the first session listed in the sidebar
+def open_session(client, username):
+    client.rerun('first_paint')
+    client.set_value('Username', string_value=username)
+    client.set_value('Password', string_value='password')
+    client.rerun('login', click='Login')
+    client.rerun('open_session', click='Session ', prefix=True)
+
+def send_message(client, text):
+    client.set_value('Type your message', string_value=text)
+    client.rerun('chat', click='Send')
+
+# Function to query the places around a point, then the details of the place at `place_index`
+def query_location(client, longitude, latitude, place_index):
+    client.set_value('Longitude', double_value=longitude)
+    client.set_value('Latitude', double_value=latitude)
+    client.rerun('query_location', click='Query Location')
+    # A selectbox value is sent as the text of the chosen option
+    options = client.find('Select a place')[3]
+    if options:
+        client.set_value('Select a place', string_value=options[min(place_index, len(options) - 1)])
+    client.rerun('query_place', click='Query Place')
+
+# Function to parse the action mix, e.g. "chat=2,location=1,rerun=1"
+def parse_mix(value):
+    weights = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ACTIONS:
+            raise argparse.ArgumentTypeError(f'unknown action {name!r}, expected one of {", ".join(ACTIONS)}')
+        weights[name] = float(weight or 1)
+    return weights
+
+# Function to start a headless streamlit server for run.py pointed at the stand-in backend
+def start_app_server(port, backend_url, cache_dir):
+    env = dict(os.environ, API_BASE_URL=backend_url, VOLUND_CACHE_DIR=cache_dir)
+    env.setdefault('BACKEND_WARMUP', '0')
+    env.setdefault('LOG_LEVEL', 'ERROR')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', APP_PATH, '--server.headless', 'true',
+         '--server.port', str(port), '--browser.gatherUsageStats', 'false'],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + SERVER_START_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'streamlit exited with status {server.returncode}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/_stcore/health', timeout=1).ok:
+                return server
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('streamlit did not start in time')
+
+# Function to read the thread count, memory (MiB) and total CPU seconds of a process from procfs
+def process_usage(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    return int(status['Threads']), int(status['VmRSS'].split()[0]) / 1024, cpu_seconds
+
+# Samples the thread count and memory of the server process while a load level runs
+class ResourceSampler(threading.Thread):
+    def __init__(self, pid, interval=0.2):
+        super().__init__(name='load-sampler', daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_mb = 0.0
+        self.cpu_seconds = None
+        self._done = threading.Event()
+
+    def run(self):
+        first = process_usage(self.pid)
+        while not self._done.is_set():
+            usage = process_usage(self.pid)
+            if usage is not None:
+                self.peak_threads = max(self.peak_threads, usage[0])
+                self.peak_rss_mb = max(self.peak_rss_mb, usage[1])
+                if first is not None:
+                    self.cpu_seconds = usage[2] - first[2]
+            self._done.wait(self.interval)
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+# Function to run one random action of a simulated user
+def run_action(client, rng, actions, weights):
+    action = rng.choices(actions, weights)[0]
+    if action == 'chat':
+        send_message(client, f'What is there to see around here? ({rng.randint(1, 10 ** 6)})')
+    elif action == 'location':
+        query_location(client, 3.0 + rng.uniform(-0.1, 0.1), 36.0 + rng.uniform(-0.1, 0.1), rng.randint(0, 20))
+    else:
+        client.rerun('rerun')
+
+# One simulated user: logs in, opens a session, then runs random actions until the deadline.
+# After an error the user starts over on a new connection.
+def simulate_user(index, url, args, deadline, results, lock):
+    rng = random.Random(args.seed * 1000 + index)
+    actions, weights = zip(*args.mix.items())
+    samples = []
+    errors = []
+    while time.monotonic() < deadline:
+        client = None
+        try:
+            with connect(f'{url}/_stcore/stream', subprotocols=['streamlit'], max_size=None,
+                         open_timeout=args.timeout) as ws:
+                client = StreamlitClient(ws, args.timeout)
+                open_session(client, f'user{index}')
+                while time.monotonic() < deadline:
+                    run_action(client, rng, actions, weights)
+                    if args.think_time:
+                        time.sleep(rng.uniform(0, 2 * args.think_time) / 1000)
+        except (FlowError, OSError, TimeoutError) as e:
+            errors.append(f'{type(e).__name__}: {e}')
+        finally:
+            if client is not None:
+                samples.extend(client.samples)
+    with lock:
+        results['samples'].extend(samples)
+        results['errors'].extend(errors)
+
+# Steps timed as user actions; logging in and opening a session are setup
+ACTION_STEPS = ('chat', 'query_location', 'query_place', 'rerun')
+
+# Function to run one load level with `users` concurrent users; returns its summary
+def run_level(users, url, server_pid, backend, args):
+    results = {'samples': [], 'errors': []}
+    lock = threading.Lock()
+    calls_before = backend.call_count()
+    sampler = ResourceSampler(server_pid)
+    sampler.start()
+    started = time.monotonic()
+    deadline = started + args.duration
+    threads = [
+        threading.Thread(target=simulate_user, args=(index, url, args, deadline, results, lock),
+                         name=f'load-user-{index}', daemon=True)
+        for index in range(users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    sampler.stop()
+
+    latencies = np.array([sample['ms'] for sample in results['samples'] if sample['step'] in ACTION_STEPS])
+    summary = {
+        'users': users,
+        'seconds': round(elapsed, 2),
+        'actions': int(latencies.size),
+        'throughput_per_s': round(latencies.size / elapsed, 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 1) if latencies.size else None,
+        'p99_ms': round(float(np.percentile(latencies, 99)), 1) if latencies.size else None,
+        'backend_calls_per_s': round((backend.call_count() - calls_before) / elapsed, 2),
+        'errors': len(results['errors']),
+        'server_threads': sampler.peak_threads,
+        'server_rss_mb': round(sampler.peak_rss_mb, 1),
+        'server_cpu_percent': round(100 * sampler.cpu_seconds / elapsed, 1) if sampler.cpu_seconds is not None else None,
+    }
+    if results['errors']:
+        summary['first_error'] = results['errors'][0]
+    return summary
+
+def print_level(summary):
+    def column(value, spec):
+        return '-' if value is None else format(value, spec)
+    print(f"{summary['users']:>6}{summary['actions']:>9}{summary['throughput_per_s']:>10.2f}"
+          f"{column(summary['p50_ms'], '.0f'):>9}{column(summary['p99_ms'], '.0f'):>9}"
+          f"{summary['backend_calls_per_s']:>11.2f}{summary['errors']:>8}{summary['server_threads']:>9}"
+          f"{column(summary['server_cpu_percent'], '.0f'):>7}{summary['server_rss_mb']:>10.0f}", flush=True)
+
+# Function to find the first user count where adding users no longer raises throughput
+def saturation_point(levels):
+    for previous, level in zip(levels, levels[1:]):
+        if previous['throughput_per_s'] and level['throughput_per_s'] < previous['throughput_per_s'] * (1 + SATURATION_GAIN):
+            return previous['users']
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test a run.py server with concurrent simulated users.')
+    parser.add_argument('--users', default='1,2,4,8', help='comma separated user counts to run in turn')
+    parser.add_argument('--duration', type=float, default=20, help='seconds every user count runs')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('chat=2,location=1,rerun=1'),
+                        help='weights of the actions users pick from (chat, location, rerun)')
+    parser.add_argument('--think-time', type=float, default=0, help='mean pause between actions, in ms')
+    parser.add_argument('--timeout', type=float, default=120, help='seconds allowed for one script run')
+    parser.add_argument('--port', type=int, default=8599, help='port of the streamlit server under test')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    user_counts = [int(value) for value in args.users.split(',') if value.strip()]
+
+    config = mock_config_from_args(args)
+    backend_server, backend = start_mock_backend(config)
+    levels = []
+    with tempfile.TemporaryDirectory(prefix='volund-load-') as scratch_dir:
+        app_server = start_app_server(args.port, f'http://127.0.0.1:{backend_server.server_address[1]}', scratch_dir)
+        try:
+            print(f"{'users':>6}{'actions':>9}{'per s':>10}{'p50 ms':>9}{'p99 ms':>9}{'calls/s':>11}{'errors':>8}"
+                  f"{'threads':>9}{'CPU %':>7}{'RSS MiB':>10}")
+            for users in user_counts:
+                summary = run_level(users, f'ws://127.0.0.1:{args.port}', app_server.pid, backend, args)
+                levels.append(summary)
+                print_level(summary)
+        finally:
+            app_server.terminate()
+            app_server.wait()
+    backend_server.shutdown()
+
+    for summary in levels:
+        if 'first_error' in summary:
+            print(f"{summary['users']} users, first error: {summary['first_error']}")
+    saturated = saturation_point(levels)
+    if saturated is not None:
+        print(f'Throughput stops growing beyond {saturated} users.')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'mock': config.as_dict(), 'mix': args.mix, 'duration': args.duration, 'levels': levels},
+                      f, indent=2)
+
+if __name__ == "__main__":
+    main()
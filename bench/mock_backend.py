@@ -0,0 +1,334 @@
+# Local stand-in for the Volund backend, used by the benchmarks and the load test.
+# Serves every endpoint run.py calls with configurable latency and payload sizes, and records each call.
+#
+#     python bench/mock_backend.py --port 8000 --sessions 50 --messages 40 --places 300 --latency 50
+#     API_BASE_URL=http://127.0.0.1:8000 streamlit run run.py
+import argparse
+import functools
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+ENDPOINTS = ('login', 'sign_up', 'session_history', 'session_by_id', 'query_location', 'query_place', 'query_ai',
+             'get_all_places', 'picture', 'ping')
+
+# Payload sizes and latencies of the stand-in backend. Latencies are in milliseconds; `latency_for`
+# overrides the base latency per endpoint name (see ENDPOINTS), `jitter` adds up to that much at random.
+class MockConfig:
+    def __init__(self, sessions=10, messages=20, places=100, message_chars=200, picture_ratio=0.0,
+                 latency=0.0, jitter=0.0, latency_for=None, stream='sse', token_delay=0.0, stream_tokens=20,
+                 incremental=True, seed=1):
+        self.sessions = sessions
+        self.messages = messages
+        self.places = places
+        self.message_chars = message_chars
+        self.picture_ratio = picture_ratio
+        self.latency = latency
+        self.jitter = jitter
+        self.latency_for = dict(latency_for or {})
+        self.stream = stream
+        self.token_delay = token_delay
+        self.stream_tokens = stream_tokens
+        self.incremental = incremental
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(vars(self))
+
+# Function to build a deterministic filler text of about `chars` characters
+def filler_text(rng, chars):
+    words = []
+    length = 0
+    while length < chars:
+        word = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 9)))
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:chars]
+
+# Function to render the single picture served for every place, as a small JPEG
+def sample_picture():
+    if Image is None:
+        return b''
+    buffer = io.BytesIO()
+    Image.new('RGB', (640, 480), (70, 130, 180)).save(buffer, 'JPEG', quality=80)
+    return buffer.getvalue()
+
+# In-memory state of the stand-in backend: users' sessions and the call log
+class MockState:
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.calls = []
+        # Requests being handled, and when the last one started or ended (see wait_idle)
+        self.in_flight = 0
+        self.last_activity = time.monotonic()
+        rng = random.Random(config.seed)
+        self.sessions = {}
+        for index in range(config.sessions):
+            session_id = f's{index + 1}'
+            self.sessions[session_id] = [
+                {'query': filler_text(rng, config.message_chars // 4),
+                 'response': filler_text(rng, config.message_chars)}
+                for _ in range(config.messages)
+            ]
+        self.places = [
+            {
+                'name': f'Place {index + 1}',
+                'latitude': 36.0 + rng.uniform(-0.2, 0.2),
+                'longitude': 3.0 + rng.uniform(-0.2, 0.2),
+                'pictures': [f'/pictures/{index + 1}.jpg'] if rng.random() < config.picture_ratio else [],
+            }
+            for index in range(config.places)
+        ]
+        self.picture = sample_picture()
+
+    def record(self, method, endpoint, path):
+        with self.lock:
+            self.calls.append((time.time(), method, endpoint, path))
+
+    def call_count(self):
+        with self.lock:
+            return len(self.calls)
+
+    def calls_since(self, start):
+        with self.lock:
+            return self.calls[start:]
+
+    def begin_request(self):
+        with self.lock:
+            self.in_flight += 1
+            self.last_activity = time.monotonic()
+
+    def end_request(self):
+        with self.lock:
+            self.in_flight -= 1
+            self.last_activity = time.monotonic()
+
+    # Waits until no request is being handled and none has started for `quiet` seconds, so calls the
+    # app makes in the background are over; returns False when still busy after `timeout` seconds
+    def wait_idle(self, quiet=0.1, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if not self.in_flight and time.monotonic() - self.last_activity >= quiet:
+                    return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def new_session(self):
+        with self.lock:
+            session_id = f's{len(self.sessions) + 1}'
+            self.sessions[session_id] = []
+            return session_id
+
+# Decorator counting a request handler as in flight in the state while it runs
+def tracked(handler):
+    @functools.wraps(handler)
+    def wrapper(self):
+        self.state.begin_request()
+        try:
+            return handler(self)
+        finally:
+            self.state.end_request()
+    return wrapper
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None  # set on the subclass created by start_mock_backend
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay(self, endpoint):
+        config = self.state.config
+        latency = config.latency_for.get(endpoint, config.latency)
+        if config.jitter:
+            latency += random.uniform(0, config.jitter)
+        if latency:
+            time.sleep(latency / 1000)
+
+    def send_json(self, body, status=200, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    @tracked
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        sessions = self.state.sessions
+        if url.path == '/session-history/':
+            self.handle_call('GET', 'session_history', url.path)
+            return self.send_json({'sessions': [
+                {'session_id': session_id, 'title': messages[0]['query'][:40] if messages else ''}
+                for session_id, messages in sessions.items()
+            ]})
+        if url.path.startswith('/session-history/'):
+            self.handle_call('GET', 'session_by_id', url.path)
+            session_id = url.path.rsplit('/', 1)[1]
+            conversation = sessions.get(session_id, [])
+            body = {'session_id': session_id}
+            since = params.get('since', [None])[0]
+            if self.state.config.incremental and since is not None and since.isdigit():
+                body['since'] = int(since)
+                body['conversation'] = conversation[int(since):]
+            else:
+                body['conversation'] = conversation
+            return self.send_json(body)
+        if url.path.startswith('/get_all_places/'):
+            self.handle_call('GET', 'get_all_places', url.path)
+            base = f'http://{self.headers.get("Host")}'
+            return self.send_json({'places': [
+                dict(place, pictures=[base + picture for picture in place['pictures']])
+                for place in self.state.places
+            ]})
+        if url.path.startswith('/pictures/'):
+            self.handle_call('GET', 'picture', url.path)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(self.state.picture)))
+            self.end_headers()
+            self.wfile.write(self.state.picture)
+            return
+        if url.path == '/':
+            self.handle_call('GET', 'ping', url.path)
+            return self.send_json({'status': 'ok'})
+        self.send_json({'detail': 'Not found'}, 404)
+
+    @tracked
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_json()
+        if url.path == '/login':
+            self.handle_call('POST', 'login', url.path)
+            return self.send_json({'access_token': f'token-{body.get("username", "")}', 'token_type': 'bearer'})
+        if url.path == '/sign_up':
+            self.handle_call('POST', 'sign_up', url.path)
+            return self.send_json({'message': 'User created'})
+        if url.path == '/query_location':
+            self.handle_call('POST', 'query_location', url.path)
+            return self.send_json({'latitude': body.get('latitude'), 'longitude': body.get('longitude'),
+                                   'response': filler_text(random.Random(0), self.state.config.message_chars)})
+        if url.path == '/query_place':
+            self.handle_call('POST', 'query_place', url.path)
+            return self.send_json({'response': f'About {body.get("place_name")}: ' +
+                                   filler_text(random.Random(0), self.state.config.message_chars)})
+        if url.path == '/query_ai':
+            self.handle_call('POST', 'query_ai', url.path)
+            return self.answer_query(body)
+        self.send_json({'detail': 'Not found'}, 404)
+
+    def handle_call(self, method, endpoint, path):
+        self.state.record(method, endpoint, path)
+        self.delay(endpoint)
+
+    # Answers a chat message as one JSON body, or token by token as server-sent events
+    def answer_query(self, body):
+        config = self.state.config
+        session_id = body.get('session_id') or self.state.new_session()
+        answer = filler_text(random.Random(len(body.get('query', ''))), config.message_chars)
+        with self.state.lock:
+            self.state.sessions.setdefault(session_id, []).append({'query': body.get('query', ''), 'response': answer})
+        if config.stream != 'sse':
+            return self.send_json({'session_id': session_id, 'response': answer})
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('X-Session-Id', session_id)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        step = max(1, len(answer) // max(1, config.stream_tokens))
+        for start in range(0, len(answer), step):
+            self.wfile.write(f'data: {json.dumps({"token": answer[start:start + step]})}\n\n'.encode())
+            self.wfile.flush()
+            if config.token_delay:
+                time.sleep(config.token_delay / 1000)
+        self.wfile.write(f'data: {json.dumps({"session_id": session_id, "response": answer})}\n\n'.encode())
+        self.wfile.write(b'data: [DONE]\n\n')
+        self.close_connection = True
+
+# Function to start the stand-in backend on a background thread; returns (server, state)
+def start_mock_backend(config=None, host='127.0.0.1', port=0):
+    state = MockState(config or MockConfig())
+    handler = type('BoundMockHandler', (MockHandler,), {'state': state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='mock-backend', daemon=True).start()
+    return server, state
+
+# Function to parse `name=ms` pairs given to --latency-for
+def parse_latency_overrides(values):
+    overrides = {}
+    for value in values or []:
+        name, _, milliseconds = value.partition('=')
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f'unknown endpoint {name!r}, expected one of {", ".join(ENDPOINTS)}')
+        overrides[name] = float(milliseconds)
+    return overrides
+
+# Function to add the stand-in backend options to a command line parser
+def add_mock_arguments(parser):
+    group = parser.add_argument_group('stand-in backend')
+    group.add_argument('--sessions', type=int, default=10, help='sessions listed for every user')
+    group.add_argument('--messages', type=int, default=20, help='messages in every session')
+    group.add_argument('--places', type=int, default=100, help='places returned by get_all_places')
+    group.add_argument('--message-chars', type=int, default=200, help='length of every answer')
+    group.add_argument('--picture-ratio', type=float, default=0.0, help='share of places with a picture')
+    group.add_argument('--latency', type=float, default=0.0, help='latency of every endpoint, in ms')
+    group.add_argument('--jitter', type=float, default=0.0, help='random extra latency, up to this many ms')
+    group.add_argument('--latency-for', action='append', metavar='ENDPOINT=MS',
+                       help='latency of one endpoint, e.g. query_ai=800 (repeatable)')
+    group.add_argument('--stream', choices=['sse', 'json'], default='sse', help='how /query_ai answers')
+    group.add_argument('--token-delay', type=float, default=0.0, help='delay between streamed tokens, in ms')
+    group.add_argument('--no-incremental', action='store_true', help='ignore ?since= and send whole sessions')
+    group.add_argument('--seed', type=int, default=1)
+
+# Function to build the stand-in backend configuration from parsed command line options
+def mock_config_from_args(args):
+    return MockConfig(
+        sessions=args.sessions, messages=args.messages, places=args.places, message_chars=args.message_chars,
+        picture_ratio=args.picture_ratio, latency=args.latency, jitter=args.jitter,
+        latency_for=parse_latency_overrides(args.latency_for), stream=args.stream, token_delay=args.token_delay,
+        incremental=not args.no_incremental, seed=args.seed,
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the stand-in Volund backend.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server, state = start_mock_backend(mock_config_from_args(args), args.host, args.port)
+    print(f'Stand-in backend on http://{args.host}:{server.server_address[1]} '
+          f'({len(state.sessions)} sessions, {len(state.places)} places)')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# Benchmarks of run.py against the local stand-in backend.
+# Runs each scripted flow (see flows.py) several times and reports, per step, the script run latency
+# percentiles and the backend calls made, plus the peak Python memory of each flow, and the cold start:
+# the import time of run.py (python -X importtime) and the first paint of the login page in a new process.
+#
+#     python bench/run_bench.py --iterations 20 --places 500 --latency 20 --save main
+#     python bench/run_bench.py --iterations 20 --places 500 --latency 20 --compare main
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import streamlit as st
+
+from flows import APP_PATH, FLOWS, AppDriver
+from mock_backend import add_mock_arguments, mock_config_from_args, start_mock_backend
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+# Latency changes below this many milliseconds are treated as noise when comparing with a baseline
+NOISE_FLOOR_MS = 5.0
+# Imports of run.py listed in the report, heaviest first
+IMPORTS_REPORTED = 8
+
+# Run in a new interpreter that already has streamlit loaded, like a server process before its first
+# session: imports run.py (for -X importtime) or times the first script run of AppTest (login page)
+IMPORT_SCRIPT = 'import streamlit, sys; sys.path.insert(0, sys.argv[1]); import run'
+FIRST_PAINT_SCRIPT = '''
+import sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=60)
+started = time.perf_counter()
+at.run()
+print((time.perf_counter() - started) * 1000)
+'''
+
+# Function to point run.py at the stand-in backend, with its local caches in a scratch directory
+def configure_app(base_url, cache_dir):
+    os.environ['API_BASE_URL'] = base_url
+    os.environ['VOLUND_CACHE_DIR'] = cache_dir
+    os.environ.setdefault('BACKEND_WARMUP', '0')
+    os.environ.setdefault('CACHE_BACKEND', 'memory')
+    os.environ.setdefault('LOG_LEVEL', 'ERROR')
+    os.environ.pop('CACHE_SQLITE_PATH', None)
+    os.environ.pop('MESSAGE_STORE_PATH', None)
+
+# Function to start every iteration from empty process-wide caches and an empty local store
+def reset_app_state(scratch_dir, iteration):
+    st.cache_data.clear()
+    st.cache_resource.clear()
+    os.environ['VOLUND_CACHE_DIR'] = os.path.join(scratch_dir, f'cold-{iteration}')
+
+# Function to run one flow `warmup + iterations` times; returns the samples of the measured iterations
+def run_flow(name, backend, args, scratch_dir):
+    samples = []
+    for iteration in range(args.warmup + args.iterations):
+        if args.cold:
+            reset_app_state(scratch_dir, f'{name}-{iteration}')
+        driver = AppDriver(backend, args.timeout)
+        FLOWS[name](driver)
+        if iteration >= args.warmup:
+            samples.extend(driver.samples)
+    return samples
+
+# Function to measure the peak Python memory allocated during one more run of a flow
+def measure_peak_memory(name, backend, args):
+    tracemalloc.start()
+    try:
+        FLOWS[name](AppDriver(backend, args.timeout))
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+# Function to parse `python -X importtime` output into {module: (cumulative us, nesting depth)}
+def parse_import_times(stderr):
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports[name.strip()] = (int(cumulative), depth)
+    return imports
+
+# Function to measure the cold start of run.py: its import time and the first paint of the login page,
+# each in a new interpreter (median of `runs`)
+def measure_startup(runs):
+    app_dir = os.path.dirname(APP_PATH)
+    import_ms = []
+    first_paint_ms = []
+    imports = {}
+    for _ in range(runs):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT, app_dir],
+                                   capture_output=True, text=True, cwd=app_dir, check=True)
+        imports = parse_import_times(completed.stderr)
+        import_ms.append(imports['run'][0] / 1000)
+        completed = subprocess.run([sys.executable, '-c', FIRST_PAINT_SCRIPT, APP_PATH],
+                                   capture_output=True, text=True, cwd=app_dir, check=True)
+        first_paint_ms.append(float(completed.stdout.split()[-1]))
+    # Direct imports of run.py are the modules one level deep listed between the previous top level
+    # import (streamlit) and run itself in the last run's tree
+    names = list(imports)
+    end = names.index('run')
+    start = max(index for index in range(end) if imports[names[index]][1] == 0) + 1
+    run_children = [name for name in names[start:end] if imports[name][1] == 1]
+    heaviest = sorted(run_children, key=lambda name: imports[name][0], reverse=True)[:IMPORTS_REPORTED]
+    return {
+        'import_ms': round(float(np.median(import_ms)), 1),
+        'first_paint_ms': round(float(np.median(first_paint_ms)), 1),
+        'heaviest_imports_ms': {name: round(imports[name][0] / 1000, 1) for name in heaviest},
+    }
+
+# Function to summarize the samples of every step: latency percentiles and backend calls per run
+def summarize(samples):
+    steps = {}
+    for sample in samples:
+        steps.setdefault(sample['step'], []).append(sample)
+    summary = {}
+    for step, step_samples in steps.items():
+        latencies = np.array([sample['ms'] for sample in step_samples])
+        calls = np.array([sample['calls'] for sample in step_samples])
+        summary[step] = {
+            'runs': len(step_samples),
+            'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+            'p90_ms': round(float(np.percentile(latencies, 90)), 2),
+            'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+            'max_ms': round(float(latencies.max()), 2),
+            'calls_per_run': round(float(calls.mean()), 2),
+        }
+    return summary
+
+def print_report(results):
+    print(f"{'flow/step':<28}{'runs':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'calls':>8}")
+    for key, stats in results['steps'].items():
+        print(f"{key:<28}{stats['runs']:>6}{stats['p50_ms']:>10.1f}{stats['p90_ms']:>10.1f}"
+              f"{stats['p99_ms']:>10.1f}{stats['max_ms']:>10.1f}{stats['calls_per_run']:>8.2f}")
+    print()
+    for flow, peak in results['peak_memory_kb'].items():
+        print(f'peak memory {flow:<16}{peak:>10.0f} KiB')
+    print(f"max RSS{'':<21}{results['max_rss_kb']:>10.0f} KiB")
+    startup = results.get('startup')
+    if startup:
+        print(f"\nimport run.py{'':<15}{startup['import_ms']:>10.1f} ms")
+        print(f"login page first paint{'':<6}{startup['first_paint_ms']:>10.1f} ms")
+        for name, milliseconds in startup['heaviest_imports_ms'].items():
+            print(f'  import {name:<20}{milliseconds:>10.1f} ms')
+
+# Function to compare results with a saved baseline; returns the list of regressions found
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"\n{'vs baseline':<28}{'p50 ms':>18}{'p99 ms':>18}{'calls':>14}")
+    for key, stats in results['steps'].items():
+        base = baseline['steps'].get(key)
+        if base is None:
+            print(f'{key:<28}{"(new)":>18}')
+            continue
+        print(f"{key:<28}{base['p50_ms']:>8.1f} -> {stats['p50_ms']:<6.1f}{base['p99_ms']:>8.1f} -> "
+              f"{stats['p99_ms']:<6.1f}{base['calls_per_run']:>6.2f} -> {stats['calls_per_run']:<6.2f}")
+        for metric in ('p50_ms', 'p99_ms'):
+            if stats[metric] > base[metric] * (1 + tolerance) and stats[metric] - base[metric] > NOISE_FLOOR_MS:
+                regressions.append(f'{key} {metric}: {base[metric]:.1f} -> {stats[metric]:.1f}')
+        if stats['calls_per_run'] > base['calls_per_run'] + 0.5:
+            regressions.append(f"{key} calls per run: {base['calls_per_run']:.2f} -> {stats['calls_per_run']:.2f}")
+    for flow, peak in results['peak_memory_kb'].items():
+        base_peak = baseline['peak_memory_kb'].get(flow)
+        if base_peak and peak > base_peak * (1 + tolerance):
+            regressions.append(f'{flow} peak memory: {base_peak:.0f} -> {peak:.0f} KiB')
+    startup, base_startup = results.get('startup'), baseline.get('startup')
+    if startup and base_startup:
+        print(f"{'startup/import':<28}{base_startup['import_ms']:>8.1f} -> {startup['import_ms']:<6.1f}")
+        print(f"{'startup/first_paint':<28}{base_startup['first_paint_ms']:>8.1f} -> {startup['first_paint_ms']:<6.1f}")
+        for metric in ('import_ms', 'first_paint_ms'):
+            if (startup[metric] > base_startup[metric] * (1 + tolerance)
+                    and startup[metric] - base_startup[metric] > NOISE_FLOOR_MS):
+                regressions.append(f'startup {metric}: {base_startup[metric]:.1f} -> {startup[metric]:.1f}')
+    if baseline.get('mock') != results['mock'] or baseline.get('cold') != results['cold']:
+        print('warning: the baseline was recorded with different settings')
+    return regressions
+
+def baseline_path(name):
+    return os.path.join(BASELINE_DIR, f'{name}.json')
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark run.py against the local stand-in backend.')
+    parser.add_argument('--flows', default=','.join(FLOWS), help=f'comma separated, from {", ".join(FLOWS)}')
+    parser.add_argument('--iterations', type=int, default=10, help='measured runs of every flow')
+    parser.add_argument('--warmup', type=int, default=1, help='unmeasured runs of every flow first')
+    parser.add_argument('--cold', action='store_true', help='clear every process-wide cache between runs')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds allowed for one script run')
+    parser.add_argument('--startup-runs', type=int, default=3,
+                        help='new processes started to time the import and first paint (0 skips it)')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--save', metavar='NAME', help='save the results as baseline NAME')
+    parser.add_argument('--compare', metavar='NAME', help='compare with baseline NAME, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before a regression')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    flows = [name.strip() for name in args.flows.split(',') if name.strip()]
+    unknown = [name for name in flows if name not in FLOWS]
+    if unknown:
+        parser.error(f'unknown flows: {", ".join(unknown)}')
+
+    config = mock_config_from_args(args)
+    server, backend = start_mock_backend(config)
+    with tempfile.TemporaryDirectory(prefix='volund-bench-') as scratch_dir:
+        configure_app(f'http://127.0.0.1:{server.server_address[1]}', os.path.join(scratch_dir, 'cache'))
+        steps = {}
+        peak_memory = {}
+        for name in flows:
+            for step, stats in summarize(run_flow(name, backend, args, scratch_dir)).items():
+                steps[f'{name}/{step}'] = stats
+            peak_memory[name] = measure_peak_memory(name, backend, args) / 1024
+        startup = measure_startup(args.startup_runs) if args.startup_runs else None
+    server.shutdown()
+
+    results = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'streamlit': st.__version__,
+        'iterations': args.iterations,
+        'cold': args.cold,
+        'mock': config.as_dict(),
+        'steps': steps,
+        'peak_memory_kb': peak_memory,
+        'startup': startup,
+        # ru_maxrss is in KiB on Linux and in bytes on macOS
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform == 'darwin' else 1),
+    }
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path(args.save), 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nSaved baseline {args.save}')
+    if args.compare:
+        with open(baseline_path(args.compare)) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\nRegressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('\nNo regressions.')
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,40 @@
+import base64
+import codecs
+import csv
+import functools
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from html import escape as escape_html
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
 import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import requests
-import json
-import folium
-from streamlit_folium import folium_static
-import pydeck as pdk
-from streamlit.components.v1 import html
+from requests.adapters import HTTPAdapter
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 # Constants
-API_BASE_URL = 'https://volund-backend.onrender.com'
+API_BASE_URL = os.environ.get('API_BASE_URL', 'https://volund-backend.onrender.com').rstrip('/')
 SESSION_HISTORY_ENDPOINT = '/session-history/'
 SESSION_BY_ID_ENDPOINT = '/session-history/{session_id}'
 QUERY_LOCATION_ENDPOINT = '/query_location'
@@ -14,6 +42,159 @@ QUERY_PLACE_ENDPOINT = '/query_place'
 GET_ALL_PLACES_ENDPOINT = '/get_all_places/{session_id}'
 SIGN_UP_ENDPOINT = '/sign_up'
 LOGIN_ENDPOINT = '/login'
+QUERY_AI_ENDPOINT = '/query_ai'
+
+# HTTP client settings
+# Connection pool sized for the number of Streamlit script threads that can hit the backend at once
+HTTP_POOL_CONNECTIONS = int(os.environ.get('HTTP_POOL_CONNECTIONS', 4))
+HTTP_POOL_MAXSIZE = int(os.environ.get('HTTP_POOL_MAXSIZE', 32))
+# (connect, read) timeouts in seconds, per endpoint
+DEFAULT_TIMEOUT = (3.05, 30)
+ENDPOINT_TIMEOUTS = {
+    LOGIN_ENDPOINT: (3.05, 15),
+    SIGN_UP_ENDPOINT: (3.05, 15),
+    SESSION_HISTORY_ENDPOINT: (3.05, 15),
+    SESSION_BY_ID_ENDPOINT: (3.05, 20),
+    QUERY_LOCATION_ENDPOINT: (3.05, 60),
+    QUERY_PLACE_ENDPOINT: (3.05, 60),
+    QUERY_AI_ENDPOINT: (3.05, 120),
+    GET_ALL_PLACES_ENDPOINT: (3.05, 30),
+}
+
+# Client policy: GETs are retried with jittered exponential backoff; after BREAKER_FAILURE_THRESHOLD
+# consecutive failures the circuit opens and calls fail fast for BREAKER_RESET_SECONDS
+RETRY_ATTEMPTS = int(os.environ.get('RETRY_ATTEMPTS', 3))
+RETRY_BACKOFF = float(os.environ.get('RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = {502, 503, 504}
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_SECONDS = float(os.environ.get('BREAKER_RESET_SECONDS', 30))
+# Warm-up ping sent once per process at start, to absorb the backend's cold start
+BACKEND_WARMUP = os.environ.get('BACKEND_WARMUP', '1') != '0'
+WARMUP_PATH = os.environ.get('WARMUP_PATH', '/')
+WARMUP_DEADLINE_SECONDS = 120
+
+# Authentication: the JWT goes in an Authorization header. Its `exp` claim is read locally, so expired
+# tokens never reach the network; TOKEN_REFRESH_MARGIN seconds before expiry the token is refreshed at
+# TOKEN_REFRESH_ENDPOINT when one is configured, otherwise the user is asked to log in again. After a
+# refresh attempt the next one waits TOKEN_REFRESH_BACKOFF seconds, so a failing endpoint is not called
+# by every backend helper of every rerun.
+# AUTH_LEGACY_TOKEN_PARAM also sends the token as a `token` param/body field, for backends that
+# only read it there; turn it off once the backend reads the header.
+TOKEN_REFRESH_ENDPOINT = os.environ.get('TOKEN_REFRESH_ENDPOINT')
+TOKEN_REFRESH_MARGIN = float(os.environ.get('TOKEN_REFRESH_MARGIN', 120))
+TOKEN_REFRESH_BACKOFF = float(os.environ.get('TOKEN_REFRESH_BACKOFF', 30))
+# Short: a refresh runs inside a script run, in front of the page
+TOKEN_REFRESH_TIMEOUT = (3.05, 10)
+AUTH_LEGACY_TOKEN_PARAM = os.environ.get('AUTH_LEGACY_TOKEN_PARAM', '1') != '0'
+
+# Observability: JSON log lines gated by LOG_LEVEL, and a per-rerun performance panel in the sidebar
+# (PERF_DEBUG=1 or ?debug=1 in the URL). PERF_LOG_PATH appends every rerun's stats as a JSON line.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+PERF_DEBUG = os.environ.get('PERF_DEBUG', '0') != '0'
+PERF_LOG_PATH = os.environ.get('PERF_LOG_PATH')
+PERF_HISTORY = 20
+
+# Background backend calls (place prefetch, session refresh) run on a shared thread pool
+BACKEND_WORKERS = int(os.environ.get('BACKEND_WORKERS', 16))
+# Number of places from a new place list whose details are fetched ahead of a click. Off by default:
+# query_place is not read-only, every prefetch adds an exchange to the conversation and costs an AI call
+PLACE_PREFETCH_COUNT = int(os.environ.get('PLACE_PREFETCH_COUNT', 0))
+
+# Response cache settings for session history and session details
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', 300))
+SESSION_CACHE_MAXSIZE = int(os.environ.get('SESSION_CACHE_MAXSIZE', 1024))
+
+# Map rendering: above this many places markers are clustered and popups are built on click
+MAP_CLUSTER_THRESHOLD = int(os.environ.get('MAP_CLUSTER_THRESHOLD', 50))
+MAP_WIDTH = 700
+MAP_HEIGHT = 500
+# Leaflet marker factory for clustered maps; the popup HTML is only built when the popup opens
+LAZY_POPUP_MARKER_JS = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(function () {
+        var content = '<b>' + row[2] + '</b>';
+        if (row[3]) {
+            content += '<br><img src="' + row[3] + '" width="100" ' +
+                'onerror="this.onerror=null;this.src=' + row[4] + '">';
+        }
+        return content;
+    }, {maxWidth: 300});
+    return marker;
+}
+"""
+
+# Place pictures are downloaded once, shrunk to popup size and served by Streamlit's static file
+# route (server.enableStaticServing) from THUMBNAIL_DIR, which is kept under THUMBNAIL_CACHE_BYTES
+THUMBNAIL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'thumbs')
+THUMBNAIL_URL_PATH = 'app/static/thumbs'
+THUMBNAIL_SIZE = (100, 100)
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('THUMBNAIL_CACHE_BYTES', 50 * 1024 * 1024))
+THUMBNAIL_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 4))
+# Accept header of picture and tile downloads, which go through the backend session (it asks for JSON)
+IMAGE_ACCEPT = 'image/webp,image/png,image/jpeg,image/*;q=0.8'
+
+# Map tiles. TILE_URL is the tile URL template the map loads ({z}/{x}/{y}; OpenStreetMap when unset).
+# With TILE_SOURCE set to an MBTiles file or a {z}/{x}/{y}.png tile directory, a local endpoint on
+# TILE_SERVER_HOST:TILE_SERVER_PORT serves the tiles instead, for use offline or on poor connections.
+# Browsers load them from TILE_PUBLIC_URL (e.g. the endpoint behind a proxy), else from that port on
+# the host they reached the app at. A tile directory missing a tile fetches it once from
+# TILE_UPSTREAM_URL, when set, and keeps it.
+TILE_URL = os.environ.get('TILE_URL')
+TILE_ATTRIBUTION = os.environ.get('TILE_ATTRIBUTION', '&copy; OpenStreetMap contributors')
+TILE_SOURCE = os.environ.get('TILE_SOURCE')
+TILE_SERVER_HOST = os.environ.get('TILE_SERVER_HOST', '127.0.0.1')
+TILE_SERVER_PORT = int(os.environ.get('TILE_SERVER_PORT', 8765))
+TILE_PUBLIC_URL = os.environ.get('TILE_PUBLIC_URL', '').rstrip('/')
+TILE_UPSTREAM_URL = os.environ.get('TILE_UPSTREAM_URL')
+TILE_USER_AGENT = 'volund-tourism-app/1.0 (offline tile cache)'
+TILE_PATH_PATTERN = re.compile(r'^/tiles/(\d+)/(\d+)/(\d+)(?:\.\w+)?$')
+# Deepest zoom level served; beyond it tile rows overflow SQLite integers and no tile set goes that deep
+TILE_MAX_ZOOM = 30
+LOOPBACK_HOSTS = ('127.0.0.1', 'localhost', '::1')
+
+# Spatial cache of location query results, shared by every session in the process.
+# Tiles are GEO_CACHE_PRECISION degrees wide (0.01 is about 1 km); a query is answered locally from
+# the places cached for its tile and the 8 surrounding tiles that lie within GEO_CACHE_RADIUS_KM.
+GEO_CACHE_PRECISION = float(os.environ.get('GEO_CACHE_PRECISION', 0.01))
+GEO_CACHE_TTL = float(os.environ.get('GEO_CACHE_TTL', 900))
+GEO_CACHE_MAXSIZE = int(os.environ.get('GEO_CACHE_MAXSIZE', 4096))
+GEO_CACHE_RADIUS_KM = float(os.environ.get('GEO_CACHE_RADIUS_KM', 10))
+EARTH_RADIUS_KM = 6371.0088
+
+# Route mode: an uploaded GPX/CSV track is thinned to waypoints and each one is queried
+ROUTE_WAYPOINT_SPACING_KM = float(os.environ.get('ROUTE_WAYPOINT_SPACING_KM', 2))
+# Waypoints handled at once on the shared thread pool; their backend queries still run one at a time
+ROUTE_MAX_CONCURRENCY = int(os.environ.get('ROUTE_MAX_CONCURRENCY', 4))
+ROUTE_RATE_LIMIT = float(os.environ.get('ROUTE_RATE_LIMIT', 20))  # location queries per second
+ROUTE_MAP_REFRESH_SECONDS = 1.0
+
+# Sidebar session list: sessions shown per page ("Load more" adds another page)
+SIDEBAR_PAGE_SIZE = int(os.environ.get('SIDEBAR_PAGE_SIZE', 20))
+
+# Conversation view: newest messages shown ("Load older messages" adds another page)
+CONVERSATION_PAGE_SIZE = int(os.environ.get('CONVERSATION_PAGE_SIZE', 30))
+
+# Shared cache backend for session history, place lists and place details: 'memory' (per process),
+# 'sqlite' (a file shared by the replicas on one host) or 'redis' (shared by every replica)
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'memory')
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+PLACE_CACHE_TTL = float(os.environ.get('PLACE_CACHE_TTL', 600))
+PLACE_CACHE_MAXSIZE = int(os.environ.get('PLACE_CACHE_MAXSIZE', 4096))
+# Values above this many bytes are zlib-compressed before they are stored
+CACHE_COMPRESS_MIN_BYTES = 512
+# The SQLite cache rewrites an entry's access time on a read at most this often, in seconds
+CACHE_ACCESS_RESOLUTION = 60
+
+# Local on-disk storage (message store and other caches)
+CACHE_DIR = os.environ.get('VOLUND_CACHE_DIR', '.volund_cache')
+CACHE_SQLITE_PATH = os.environ.get('CACHE_SQLITE_PATH', os.path.join(CACHE_DIR, 'cache.sqlite3'))
+MESSAGE_STORE_PATH = os.environ.get('MESSAGE_STORE_PATH', os.path.join(CACHE_DIR, 'messages.sqlite3'))
+# Sessions kept in the message store; the least recently synced ones are dropped beyond this
+MESSAGE_STORE_MAX_SESSIONS = int(os.environ.get('MESSAGE_STORE_MAX_SESSIONS', 1000))
+# Ask the backend only for messages after the last one stored locally
+INCREMENTAL_SYNC = os.environ.get('INCREMENTAL_SYNC', '1') != '0'
 
 def validate_latitude(lat):
     if lat is None:
@@ -25,25 +206,1219 @@ def validate_longitude(lon):
         return False
     return -180 <= lon <= 180
 
+# Shared HTTP session for the whole process: keeps connections to the backend alive between reruns and users
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive',
+    })
+    return session
+
+# Thread pool shared by all sessions for backend calls that run alongside the script thread
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=BACKEND_WORKERS, thread_name_prefix='volund-backend')
+
+# Collapses concurrent identical backend calls: the first caller runs the call, callers that arrive
+# while it is in flight wait for it and share its result. Counters are kept per endpoint, and exported
+# with the process metrics as coalesce_executed / coalesce_collapsed.
+class SingleFlight:
+    def __init__(self):
+        self.executed = Counter()
+        self.collapsed = Counter()
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, name, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+                self.executed[name] += 1
+            else:
+                self.collapsed[name] += 1
+        record('coalesce_executed' if leader else 'coalesce_collapsed', endpoint=name)
+        if not leader:
+            return call.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+@st.cache_resource
+def get_single_flight():
+    return SingleFlight()
+
+# One lock per backend session, for calls that change what the session holds (query_location then
+# get_all_places as one unit, query_place). Locks are dropped once nobody holds a reference.
+class SessionLocks:
+    def __init__(self):
+        self._locks = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = threading.Lock()
+            return lock
+
+@st.cache_resource
+def get_session_locks():
+    return SessionLocks()
+
+# Raised instead of calling the backend while the circuit breaker is open
+class BackendUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+# Raised instead of calling the backend with an expired or rejected token
+class TokenExpired(requests.exceptions.RequestException):
+    pass
+
+# Circuit breaker shared by all backend calls: closed -> open after repeated failures ->
+# half-open (one trial call) after the reset timeout -> closed again on success
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                return True
+            return False
+
+    def retry_in(self):
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+@st.cache_resource
+def get_circuit_breaker():
+    return CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+# Ping the backend once per process in the background so a cold start is over before the first login
+@st.cache_resource
+def start_backend_warmup():
+    def warm_up():
+        deadline = time.monotonic() + WARMUP_DEADLINE_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                # Any HTTP answer means the backend is up
+                get_http_session().get(API_BASE_URL + WARMUP_PATH, timeout=(3.05, 60))
+                return
+            except requests.exceptions.RequestException:
+                time.sleep(5)
+
+    thread = threading.Thread(target=warm_up, name='volund-warmup', daemon=True)
+    thread.start()
+    return thread
+
+# Function to show an error in the page, or log it when called from a background thread
+def report_error(message):
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.error(message)
+    else:
+        log_event(logging.ERROR, message)
+
+# Function to show a warning in the page, or log it when called from a background thread
+def report_warning(message):
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.warning(message)
+    else:
+        log_event(logging.WARNING, message)
+
+# Formats log records as one JSON object per line, with the fields passed to log_event
+class JSONLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname.lower(), 'event': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+def get_logger():
+    logger = logging.getLogger('volund')
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(JSONLogFormatter())
+        logger.addHandler(handler)
+        logger.propagate = False
+    logger.setLevel(LOG_LEVEL)
+    return logger
+
+log = get_logger()
+
+# Function to write a structured log line; fields are only formatted when the level is enabled
+def log_event(level, event, **fields):
+    if log.isEnabledFor(level):
+        log.log(level, event, extra={'fields': fields})
+
+# Process-wide counters and span timings, exportable as Prometheus text
+class Metrics:
+    def __init__(self):
+        self.counters = Counter()
+        self.timings = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            count, total, peak = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + seconds, max(peak, seconds))
+
+    def prometheus(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+        typed = set()
+        for (name, labels), value in counters:
+            metric = f'volund_{name}_total'
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            label_text = ','.join(f'{key}="{value_}"' for key, value_ in labels)
+            lines.append(f'{metric}{{{label_text}}} {value}' if label_text else f'{metric} {value}')
+        if timings:
+            lines.append('# TYPE volund_span_seconds summary')
+        for name, (count, total, peak) in timings:
+            lines.append(f'volund_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'volund_span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'volund_span_seconds_max{{span="{name}"}} {peak:.6f}')
+        return '\n'.join(lines) + '\n'
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# Function to get the stats of the script run in progress for this user session (None on worker threads)
+def current_rerun_stats():
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.get('perf_rerun')
+
+# Function to start collecting stats for a full run ('app') or a fragment-only rerun
+def begin_rerun(kind):
+    st.session_state['perf_rerun'] = {'kind': kind, 'started': time.time(), 'spans': [], 'counters': Counter()}
+
+# Function to close the stats of the current run and keep them in the rerun history
+def end_rerun():
+    stats = st.session_state.get('perf_rerun')
+    if not stats or 'duration_ms' in stats:
+        return
+    duration = time.time() - stats['started']
+    stats['duration_ms'] = round(duration * 1000, 2)
+    get_metrics().observe('rerun', duration)
+    history = st.session_state.setdefault('perf_history', [])
+    history.append(stats)
+    del history[:-PERF_HISTORY]
+    if PERF_LOG_PATH:
+        with open(PERF_LOG_PATH, 'a') as f:
+            f.write(rerun_json_line(stats) + '\n')
+
+# Function to serialize one rerun's stats as a JSON line
+def rerun_json_line(stats):
+    return json.dumps({
+        'kind': stats['kind'],
+        'started': round(stats['started'], 3),
+        'duration_ms': stats.get('duration_ms'),
+        'counters': dict(stats['counters']),
+        'spans': stats['spans'],
+    })
+
+# Function to count an event, process-wide and for the current rerun
+def record(name, value=1, **labels):
+    get_metrics().inc(name, value, **labels)
+    stats = current_rerun_stats()
+    if stats is not None:
+        stats['counters'][':'.join([name, *(str(label) for _, label in sorted(labels.items()))])] += value
+
+# Context manager timing a block, process-wide and for the current rerun
+@contextmanager
+def perf_span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        get_metrics().observe(name, elapsed)
+        stats = current_rerun_stats()
+        if stats is not None:
+            stats['spans'].append((name, round(elapsed * 1000, 2)))
+
+# Decorator timing every call of a backend helper
+def timed(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with perf_span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+# Decorator for fragment functions: a fragment-only rerun gets its own stats entry
+def perf_fragment(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if st.session_state.get('perf_in_app_run'):
+            with perf_span(func.__name__):
+                return func(*args, **kwargs)
+        begin_rerun(func.__name__)
+        try:
+            with perf_span(func.__name__):
+                return func(*args, **kwargs)
+        finally:
+            end_rerun()
+    return wrapper
+
+# Function to check whether the performance panel is shown
+def perf_debug_enabled():
+    return PERF_DEBUG or st.query_params.get('debug') == '1'
+
+# Spaces out calls so that at most `rate` of them start per second, across threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Function to serialize a cache value to compact bytes: msgpack when available, JSON otherwise,
+# zlib-compressed when large. The first byte records the format.
+def pack_value(value):
+    if msgpack is not None:
+        data, kind = msgpack.packb(value, use_bin_type=True), b'm'
+    else:
+        data, kind = json.dumps(value, separators=(',', ':')).encode(), b'j'
+    if len(data) >= CACHE_COMPRESS_MIN_BYTES:
+        return kind.upper() + zlib.compress(data)
+    return kind + data
+
+# Function to read back a value written by pack_value
+def unpack_value(blob):
+    kind, data = blob[:1], blob[1:]
+    if kind.isupper():
+        kind, data = kind.lower(), zlib.decompress(data)
+    if kind == b'm':
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+# Interface shared by the cache backends. Keys are strings, values are JSON-like data.
+# Entries expire after `ttl` seconds but are kept (for stale reads while the backend is down)
+# until the size limit evicts the least recently used ones.
+class CacheBackend:
+    def __init__(self, namespace, maxsize, ttl):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        entry = self._read(key)
+        if entry is None or entry[0] < time.time():
+            self.misses += 1
+            record('cache_miss', cache=self.namespace)
+            return default
+        self.hits += 1
+        record('cache_hit', cache=self.namespace)
+        return entry[1]
+
+    def get_stale(self, key, default=None):
+        entry = self._read(key)
+        return default if entry is None else entry[1]
+
+    def _read(self, key):
+        # Returns (expires_at, value) or None
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def delete_prefix(self, prefix):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+# In-process LRU cache, the default backend
+class TTLCache(CacheBackend):
+    def __init__(self, namespace, maxsize, ttl):
+        super().__init__(namespace, maxsize, ttl)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _read(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            for key in [key for key in self._data if key.startswith(prefix)]:
+                del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+# Cache in a local SQLite file, shared by every process on the host. A locked or unreadable file
+# degrades to a cache that misses and drops writes, like a Redis outage.
+class SQLiteCache(CacheBackend):
+    def __init__(self, path, namespace, maxsize, ttl):
+        super().__init__(namespace, maxsize, ttl)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        # Waits at most a second for another process's write, as long as a Redis socket timeout
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=1)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'namespace TEXT NOT NULL, key TEXT NOT NULL, expires_at REAL NOT NULL, '
+                'accessed_at REAL NOT NULL, value BLOB NOT NULL, PRIMARY KEY (namespace, key))'
+            )
+            self._conn.execute('CREATE INDEX IF NOT EXISTS cache_lru ON cache (namespace, accessed_at)')
+
+    def _failed(self, operation, error):
+        record('cache_errors', cache=self.namespace)
+        log_event(logging.WARNING, 'cache.sqlite_failed', cache=self.namespace, operation=operation, error=str(error))
+
+    def _read(self, key):
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    'SELECT expires_at, accessed_at, value FROM cache WHERE namespace = ? AND key = ?',
+                    (self.namespace, key)
+                ).fetchone()
+        except sqlite3.Error as e:
+            self._failed('get', e)
+            return None
+        if row is None:
+            return None
+        # Reads stay read-only: the access time is only rewritten once it is CACHE_ACCESS_RESOLUTION old
+        now = time.time()
+        if now - row[1] >= CACHE_ACCESS_RESOLUTION:
+            try:
+                with self._lock, self._conn:
+                    self._conn.execute(
+                        'UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?', (now, self.namespace, key)
+                    )
+            except sqlite3.Error as e:
+                self._failed('touch', e)
+        return row[0], unpack_value(row[2])
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO cache (namespace, key, expires_at, accessed_at, value) VALUES (?, ?, ?, ?, ?)',
+                    (self.namespace, key, now + self.ttl, now, pack_value(value))
+                )
+                self._conn.execute(
+                    'DELETE FROM cache WHERE namespace = ? AND key IN ('
+                    'SELECT key FROM cache WHERE namespace = ? ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                    (self.namespace, self.namespace, self.maxsize)
+                )
+        except sqlite3.Error as e:
+            self._failed('set', e)
+
+    def delete(self, key):
+        try:
+            with self._lock, self._conn:
+                self._conn.execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (self.namespace, key))
+        except sqlite3.Error as e:
+            self._failed('delete', e)
+
+    def delete_prefix(self, prefix):
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        try:
+            with self._lock, self._conn:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE namespace = ? AND key LIKE ? ESCAPE '\\'", (self.namespace, pattern)
+                )
+        except sqlite3.Error as e:
+            self._failed('delete_prefix', e)
+
+    def __len__(self):
+        try:
+            with self._lock:
+                return self._conn.execute('SELECT COUNT(*) FROM cache WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+        except sqlite3.Error as e:
+            self._failed('len', e)
+            return 0
+
+# Cache in Redis (or anything speaking its protocol), shared by every replica. Redis expires keys
+# after `stale_factor` TTLs; a sorted set of access times per namespace evicts the least recently
+# used keys beyond `maxsize`.
+# A Redis outage degrades to a cache that misses and drops writes; it never fails the page.
+class RedisCache(CacheBackend):
+    def __init__(self, client, namespace, maxsize, ttl, stale_factor=6):
+        # Imported here, like in get_redis_client: only this backend needs the package
+        from redis.exceptions import RedisError
+
+        super().__init__(namespace, maxsize, ttl)
+        self.client = client
+        self.prefix = f'volund:{namespace}:'
+        # Outside the prefix, so scans of the entries never match it
+        self.index = f'volund:{namespace}'
+        self.retention = int(ttl * stale_factor) + 1
+        self._errors = RedisError
+
+    def _failed(self, operation, error):
+        record('cache_errors', cache=self.namespace)
+        log_event(logging.WARNING, 'cache.redis_failed', cache=self.namespace, operation=operation, error=str(error))
+
+    def _read(self, key):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.get(self.prefix + key)
+            pipe.zadd(self.index, {key: time.time()}, xx=True)
+            blob = pipe.execute()[0]
+        except self._errors as e:
+            self._failed('get', e)
+            return None
+        if blob is None:
+            return None
+        return unpack_value(blob)
+
+    def set(self, key, value):
+        now = time.time()
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(self.prefix + key, pack_value([now + self.ttl, value]), ex=self.retention)
+            pipe.zadd(self.index, {key: now})
+            pipe.expire(self.index, self.retention)
+            pipe.zcard(self.index)
+            count = pipe.execute()[-1]
+            if count > self.maxsize:
+                evicted = self.client.zpopmin(self.index, count - self.maxsize)
+                if evicted:
+                    self.client.delete(*(self.prefix.encode() + member for member, _ in evicted))
+        except self._errors as e:
+            self._failed('set', e)
+
+    def delete(self, key):
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.delete(self.prefix + key)
+            pipe.zrem(self.index, key)
+            pipe.execute()
+        except self._errors as e:
+            self._failed('delete', e)
+
+    def delete_prefix(self, prefix):
+        pattern = ''.join('\\' + char if char in '\\*?[]' else char for char in self.prefix + prefix) + '*'
+        try:
+            keys = list(self.client.scan_iter(match=pattern, count=500))
+            if keys:
+                pipe = self.client.pipeline(transaction=False)
+                pipe.delete(*keys)
+                pipe.zrem(self.index, *(key[len(self.prefix.encode()):] for key in keys))
+                pipe.execute()
+        except self._errors as e:
+            self._failed('delete_prefix', e)
+
+    def __len__(self):
+        try:
+            return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*', count=500))
+        except self._errors as e:
+            self._failed('len', e)
+            return 0
+
+@st.cache_resource
+def get_redis_client():
+    # Imported only when the redis backend is configured; the import alone takes tens of milliseconds
+    try:
+        import redis
+    except ImportError:
+        raise RuntimeError("CACHE_BACKEND=redis needs the 'redis' package")
+    return redis.Redis.from_url(CACHE_REDIS_URL, socket_timeout=1, socket_connect_timeout=1)
+
+# Function to create a cache for one kind of data with the configured backend
+def create_cache(namespace, maxsize, ttl):
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteCache(CACHE_SQLITE_PATH, namespace, maxsize, ttl)
+    if CACHE_BACKEND == 'redis':
+        return RedisCache(get_redis_client(), namespace, maxsize, ttl)
+    return TTLCache(namespace, maxsize, ttl)
+
+# Function to build a cache key scoped to a token without putting the token itself in the key
+def session_cache_key(token, *parts):
+    token_hash = hashlib.sha256(str(token).encode()).hexdigest()[:24]
+    return ':'.join([token_hash, *map(str, parts)])
+
+# Process-wide cache for session history and session details, keyed by token
+@st.cache_resource
+def get_session_cache():
+    return create_cache('session', SESSION_CACHE_MAXSIZE, SESSION_CACHE_TTL)
+
+# Process-wide cache for place details (query_place answers), keyed by token, session and place
+@st.cache_resource
+def get_place_cache():
+    return create_cache('place', PLACE_CACHE_MAXSIZE, PLACE_CACHE_TTL)
+
+# Local per-session copy of conversations, so a session is synced by fetching only new messages.
+# Holds at most `max_sessions` sessions; the least recently synced ones are dropped (and fully
+# fetched again if they are opened later).
+class MessageStore:
+    def __init__(self, path, max_sessions):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS sessions ('
+                'session_id TEXT PRIMARY KEY, details TEXT NOT NULL, synced_at REAL NOT NULL DEFAULT 0)'
+            )
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(sessions)')]
+            if 'synced_at' not in columns:
+                # Stores created before eviction existed
+                self._conn.execute('ALTER TABLE sessions ADD COLUMN synced_at REAL NOT NULL DEFAULT 0')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS sessions_synced ON sessions (synced_at)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages ('
+                'session_id TEXT NOT NULL, idx INTEGER NOT NULL, message TEXT NOT NULL, '
+                'PRIMARY KEY (session_id, idx))'
+            )
+
+    def count(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,)
+            ).fetchone()
+        return row[0]
+
+    def load(self, session_id):
+        with self._lock:
+            details = self._conn.execute(
+                'SELECT details FROM sessions WHERE session_id = ?', (session_id,)
+            ).fetchone()
+            rows = self._conn.execute(
+                'SELECT message FROM messages WHERE session_id = ? ORDER BY idx', (session_id,)
+            ).fetchall()
+        if details is None:
+            return None
+        session_details = json.loads(details[0])
+        session_details['conversation'] = [json.loads(row[0]) for row in rows]
+        return session_details
+
+    def save(self, session_id, session_details, messages, start=0):
+        # Replaces every message from `start` on; start=0 rewrites the whole conversation
+        details = {key: value for key, value in session_details.items() if key not in ('conversation', 'since')}
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sessions (session_id, details, synced_at) VALUES (?, ?, ?)',
+                (session_id, json.dumps(details), time.time())
+            )
+            self._conn.execute('DELETE FROM messages WHERE session_id = ? AND idx >= ?', (session_id, start))
+            self._conn.executemany(
+                'INSERT INTO messages (session_id, idx, message) VALUES (?, ?, ?)',
+                [(session_id, start + i, json.dumps(message)) for i, message in enumerate(messages)]
+            )
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT session_id FROM sessions ORDER BY synced_at DESC LIMIT -1 OFFSET ?', (self.max_sessions,)
+            ).fetchall()
+        for (session_id,) in rows:
+            self.delete(session_id)
+
+    def first_queries(self, session_ids):
+        # First user message of the given sessions, used as a fallback session title. Keyed by
+        # str(session_id): the column is TEXT, whatever type the ids were stored with.
+        session_ids = [str(session_id) for session_id in session_ids]
+        rows = []
+        with self._lock:
+            # Chunked to stay under SQLite's limit on query parameters
+            for start in range(0, len(session_ids), 500):
+                chunk = session_ids[start:start + 500]
+                rows += self._conn.execute(
+                    'SELECT session_id, message FROM messages WHERE idx = 0 AND session_id IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk
+                ).fetchall()
+        return {session_id: json.loads(message).get('query') or '' for session_id, message in rows}
+
+    def delete(self, session_id):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+            self._conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+
+@st.cache_resource
+def get_message_store():
+    return MessageStore(MESSAGE_STORE_PATH, MESSAGE_STORE_MAX_SESSIONS)
+
+# Function to compute the great-circle distance between two points in kilometres
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+# Places found by location queries, stored per quantized lat/lon tile
+class GeoTileCache:
+    def __init__(self, precision, ttl, maxsize):
+        self.precision = precision
+        self.hits = 0
+        self.misses = 0
+        self._tiles = create_cache('geo', maxsize, ttl)
+
+    def tile(self, latitude, longitude):
+        return (math.floor(latitude / self.precision), math.floor(longitude / self.precision))
+
+    def put(self, latitude, longitude, places):
+        self._tiles.set('%d:%d' % self.tile(latitude, longitude), places)
+
+    def lookup(self, latitude, longitude, radius_km):
+        row, col = self.tile(latitude, longitude)
+        seen = set()
+        places = []
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                for place in self._tiles.get('%d:%d' % (row + d_row, col + d_col)) or []:
+                    key = (place.get('name'), place.get('latitude'), place.get('longitude'))
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    if haversine_km(latitude, longitude, place['latitude'], place['longitude']) <= radius_km:
+                        places.append(place)
+        if places:
+            self.hits += 1
+            return places
+        self.misses += 1
+        return None
+
+    def __len__(self):
+        return len(self._tiles)
+
+@st.cache_resource
+def get_geo_cache():
+    return GeoTileCache(GEO_CACHE_PRECISION, GEO_CACHE_TTL, GEO_CACHE_MAXSIZE)
+
+# Compact, column-oriented place list kept per user session: coordinate arrays, interned
+# name and first-picture columns, and a name -> row index.
+# numpy is imported by the methods, on the first place list: the login page does not need it.
+class PlaceStore:
+    def __init__(self, places):
+        import numpy as np
+
+        self.latitudes = np.array([float(place['latitude']) for place in places], dtype=np.float64)
+        self.longitudes = np.array([float(place['longitude']) for place in places], dtype=np.float64)
+        self.names = [sys.intern(str(place.get('name', ''))) for place in places]
+        self.pictures = [sys.intern(picture) if picture else None for picture in map(place_picture, places)]
+        self._rows = {}
+        for row, name in enumerate(self.names):
+            self._rows.setdefault(name, row)
+        digest = hashlib.sha1(self.latitudes.tobytes() + self.longitudes.tobytes())
+        digest.update('\0'.join(self.names).encode())
+        digest.update('\0'.join(picture or '' for picture in self.pictures).encode())
+        self.digest = digest.hexdigest()
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, name):
+        return self._rows.get(name)
+
+    def distances_km(self, latitude, longitude):
+        import numpy as np
+
+        lat1, lon1 = math.radians(latitude), math.radians(longitude)
+        lat2, lon2 = np.radians(self.latitudes), np.radians(self.longitudes)
+        a = np.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+    def ranked(self, latitude, longitude, radius_km=None):
+        # Rows ordered by distance from the point, optionally limited to `radius_km`
+        import numpy as np
+
+        distances = self.distances_km(latitude, longitude)
+        rows = np.argsort(distances, kind='stable')
+        if radius_km:
+            rows = rows[distances[rows] <= radius_km]
+        return rows, distances
+
+    def nearest(self, latitude, longitude, k):
+        import numpy as np
+
+        if k <= 0 or not len(self):
+            return np.empty(0, dtype=np.intp)
+        distances = self.distances_km(latitude, longitude)
+        if k < len(self):
+            rows = np.argpartition(distances, k - 1)[:k]
+        else:
+            rows = np.arange(len(self))
+        return rows[np.argsort(distances[rows], kind='stable')]
+
+# On-disk LRU cache of place picture thumbnails, bounded by a byte budget.
+# Files are named by a hash of the source URL; their mtime is the last use.
+class ThumbnailCache:
+    def __init__(self, directory, max_bytes, workers):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='volund-thumbs')
+        self._sizes = {
+            entry.name: entry.stat().st_size for entry in os.scandir(directory) if entry.name.endswith('.jpg')
+        }
+        self.total_bytes = sum(self._sizes.values())
+
+    def file_name(self, url):
+        return hashlib.sha1(url.encode()).hexdigest() + '.jpg'
+
+    def url_for(self, url):
+        return f'{THUMBNAIL_URL_PATH}/{self.file_name(url)}'
+
+    def schedule(self, urls):
+        # Queue downloads for pictures that have no thumbnail yet; known ones are marked as used
+        for url in urls:
+            if not url:
+                continue
+            name = self.file_name(url)
+            with self._lock:
+                if name in self._sizes:
+                    try:
+                        os.utime(os.path.join(self.directory, name))
+                    except OSError:
+                        self._sizes.pop(name, None)
+                    continue
+                if name in self._pending:
+                    continue
+                self._pending.add(name)
+            self._executor.submit(self._create, url, name)
+
+    def _create(self, url, name):
+        # Only imported on this pool's threads, once a map has pictures to shrink
+        from PIL import Image
+
+        try:
+            response = get_http_session().get(url, headers={'Accept': IMAGE_ACCEPT}, timeout=(3.05, 10), stream=True)
+            response.raise_for_status()
+            data = response.raw.read(THUMBNAIL_MAX_SOURCE_BYTES + 1, decode_content=True)
+            if len(data) > THUMBNAIL_MAX_SOURCE_BYTES:
+                return
+            image = Image.open(io.BytesIO(data))
+            image.thumbnail(THUMBNAIL_SIZE)
+            buffer = io.BytesIO()
+            image.convert('RGB').save(buffer, 'JPEG', quality=70, optimize=True)
+            path = os.path.join(self.directory, name)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(path + '.tmp', path)
+            with self._lock:
+                self._sizes[name] = buffer.tell()
+                self.total_bytes += buffer.tell()
+            self._evict()
+        except (requests.exceptions.RequestException, OSError, Image.DecompressionBombError) as e:
+            log_event(logging.WARNING, 'thumbnail.failed', url=url, error=str(e))
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _evict(self):
+        with self._lock:
+            if self.total_bytes <= self.max_bytes:
+                return
+            entries = sorted(os.scandir(self.directory), key=lambda entry: entry.stat().st_mtime)
+            for entry in entries:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if entry.name in self._sizes:
+                    self.total_bytes -= self._sizes.pop(entry.name)
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+
+@st.cache_resource
+def get_thumbnail_cache():
+    # Pictures are only shrunk when Pillow is installed; its import is left to the download threads
+    if importlib.util.find_spec('PIL') is None:
+        return None
+    return ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_BYTES, THUMBNAIL_WORKERS)
+
+# Raster map tiles read from an MBTiles file (SQLite, rows in TMS order) or a {z}/{x}/{y}.png directory.
+# A directory store fills missing tiles from the upstream URL, when one is given.
+class TileStore:
+    def __init__(self, source, upstream_url=None):
+        self.source = source
+        self.upstream_url = upstream_url
+        self.is_mbtiles = os.path.isfile(source)
+        self._connection = None
+        self._lock = threading.Lock()
+        if self.is_mbtiles:
+            self._connection = sqlite3.connect(f'file:{source}?mode=ro', uri=True, check_same_thread=False)
+
+    def get(self, z, x, y):
+        if self.is_mbtiles:
+            with self._lock:
+                row = self._connection.execute(
+                    'SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                    (z, x, (1 << z) - 1 - y),
+                ).fetchone()
+            return bytes(row[0]) if row else None
+        path = os.path.join(self.source, str(z), str(x), f'{y}.png')
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        if not self.upstream_url:
+            return None
+        return self._fetch(z, x, y, path)
+
+    def _fetch(self, z, x, y, path):
+        try:
+            response = get_http_session().get(self.upstream_url.format(z=z, x=x, y=y), timeout=(3.05, 15),
+                                              headers={'User-Agent': TILE_USER_AGENT, 'Accept': IMAGE_ACCEPT})
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log_event(logging.WARNING, 'tile.fetch_failed', z=z, x=x, y=y, error=str(e))
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(response.content)
+        os.replace(temporary_path, path)
+        record('tiles_fetched')
+        return response.content
+
+# Function to tell the image type of a tile from its first bytes
+def tile_content_type(data):
+    if data.startswith(b'\x89PNG'):
+        return 'image/png'
+    if data.startswith(b'\xff\xd8'):
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return 'application/octet-stream'
+
+# Local tile endpoint: GET /tiles/{z}/{x}/{y}.png from the tile store
+class TileRequestHandler(BaseHTTPRequestHandler):
+    store = None  # set on the subclass created by get_tile_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = TILE_PATH_PATTERN.match(self.path.split('?', 1)[0])
+        z, x, y = (int(part) for part in match.groups()) if match else (-1, 0, 0)
+        # Out-of-range coordinates never reach the store (nor, for a tile directory, the upstream server)
+        data = self.store.get(z, x, y) if 0 <= z <= TILE_MAX_ZOOM and x < 1 << z and y < 1 << z else None
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', tile_content_type(data))
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'public, max-age=86400')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        self.wfile.write(data)
+
+# Function to start the local tile endpoint once per process. Returns None if the port is taken,
+# e.g. by another replica on this host serving the same tiles.
+@st.cache_resource
+def get_tile_server():
+    handler = type('BoundTileRequestHandler', (TileRequestHandler,), {'store': TileStore(TILE_SOURCE, TILE_UPSTREAM_URL)})
+    try:
+        server = ThreadingHTTPServer((TILE_SERVER_HOST, TILE_SERVER_PORT), handler)
+    except OSError as e:
+        log_event(logging.WARNING, 'tile_server.unavailable', port=TILE_SERVER_PORT, error=str(e))
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='volund-tiles', daemon=True).start()
+    return server
+
+# Function to get the tile URL template the map loads, starting the local endpoint if tiles are local.
+# Without TILE_PUBLIC_URL the endpoint is addressed by the host the browser reached the app at; when it
+# only listens on loopback and the browser is elsewhere, the map falls back to online tiles.
+def map_tile_url():
+    if not TILE_SOURCE or TILE_URL:
+        return TILE_URL
+    get_tile_server()
+    if TILE_PUBLIC_URL:
+        return TILE_PUBLIC_URL + '/tiles/{z}/{x}/{y}.png'
+    hostname = urlsplit('//' + st.context.headers.get('Host', '')).hostname or 'localhost'
+    if TILE_SERVER_HOST in LOOPBACK_HOSTS and hostname not in LOOPBACK_HOSTS:
+        warn_tiles_unreachable(hostname)
+        return None
+    host = f'[{hostname}]' if ':' in hostname else hostname
+    return f'http://{host}:{TILE_SERVER_PORT}/tiles/{{z}}/{{x}}/{{y}}.png'
+
+# Function to log, once per browser host, that the local tile endpoint cannot be reached from it
+@functools.lru_cache(maxsize=None)
+def warn_tiles_unreachable(hostname):
+    log_event(logging.WARNING, 'tile_server.unreachable', host=hostname, listen=TILE_SERVER_HOST,
+              hint='set TILE_PUBLIC_URL, or TILE_SERVER_HOST=0.0.0.0')
+
+# Function to get the URL a popup should load for a picture: the local thumbnail when thumbnails are
+# enabled (the popup falls back to the original if it is not ready yet), else the original
+def thumbnail_url(picture):
+    thumbnails = get_thumbnail_cache()
+    return thumbnails.url_for(picture) if thumbnails is not None else picture
+
+# Function to drop cached session details (and the session list for new sessions) after the data changed
+def invalidate_session_cache(token, session_id=None):
+    cache = get_session_cache()
+    if session_id:
+        cache.delete(session_cache_key(token, 'session', session_id))
+    else:
+        cache.delete(session_cache_key(token, 'history'))
+        cache.delete(session_cache_key(token, 'titles'))
+
+# Function to drop everything cached for a token (logout)
+def invalidate_token_cache(token):
+    get_session_cache().delete_prefix(session_cache_key(token) + ':')
+    get_place_cache().delete_prefix(session_cache_key(token) + ':')
+
+# Function to read the expiry time (epoch seconds) from a JWT's `exp` claim; None when absent.
+# The signature is not checked: this only decides when to stop using the token.
+def jwt_expiry(token):
+    try:
+        payload = token.split('.')[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return float(claims['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+# Function to log the user out after their token expired or was rejected, keeping a notice for the login page
+def expire_session(token):
+    invalidate_token_cache(token)
+    cancel_place_prefetch()
+    st.session_state.pop('token', None)
+    st.session_state.pop('token_refresh_after', None)
+    st.session_state['auth_notice'] = 'Your session has expired. Please log in again.'
+
+# Function to stop using an expired or rejected token: in a script run of the user it belongs to, the
+# user is sent back to the login page; anywhere else the call fails with TokenExpired
+def reject_token(token):
+    if get_script_run_ctx(suppress_warning=True) is not None and st.session_state.get('token') == token:
+        expire_session(token)
+        st.rerun()
+    raise TokenExpired('The session token has expired.')
+
+# Function to refresh the token at TOKEN_REFRESH_ENDPOINT; returns the new token, or None
+def refresh_jwt_token(token):
+    try:
+        response = api_request('POST', TOKEN_REFRESH_ENDPOINT, headers={'Authorization': f'Bearer {token}'},
+                               timeout=TOKEN_REFRESH_TIMEOUT)
+    except requests.exceptions.RequestException as e:
+        log_event(logging.WARNING, 'token.refresh_failed', error=str(e))
+        return None
+    if response.status_code != 200:
+        log_event(logging.WARNING, 'token.refresh_failed', status=response.status_code)
+        return None
+    try:
+        return response.json()['access_token']
+    except (ValueError, KeyError):
+        return None
+
+# Function to get the user's token for this run: refreshed when it is about to expire and a refresh
+# endpoint is configured (at most once per TOKEN_REFRESH_BACKOFF); None (and the user logged out)
+# when it has expired
+def current_token():
+    token = st.session_state['token']
+    expires_at = jwt_expiry(token)
+    if expires_at is None or expires_at - time.time() > TOKEN_REFRESH_MARGIN:
+        return token
+    if TOKEN_REFRESH_ENDPOINT and time.time() >= st.session_state.get('token_refresh_after', 0):
+        st.session_state['token_refresh_after'] = time.time() + TOKEN_REFRESH_BACKOFF
+        refreshed = refresh_jwt_token(token)
+        if refreshed:
+            st.session_state['token'] = refreshed
+            return refreshed
+    if expires_at <= time.time():
+        expire_session(token)
+        return None
+    return token
+
+# Function to get the token inside the chat page, including fragment-only reruns, which Streamlit runs
+# with the arguments of the last full run: reading it here keeps refreshes and expiry checks going in
+# a panel used on its own. An expired token reruns the whole app, back to the login page.
+def session_token():
+    token = current_token() if 'token' in st.session_state else None
+    if token is None:
+        st.rerun()
+    return token
+
+# Function to add the token to a request: an Authorization header, plus the legacy `token` field
+# in the JSON body or query params when AUTH_LEGACY_TOKEN_PARAM is on
+def authorize_request(token, kwargs):
+    kwargs['headers'] = {**(kwargs.get('headers') or {}), 'Authorization': f'Bearer {token}'}
+    if AUTH_LEGACY_TOKEN_PARAM:
+        if 'json' in kwargs:
+            kwargs['json'] = {**kwargs['json'], 'token': token}
+        else:
+            kwargs['params'] = {**(kwargs.get('params') or {}), 'token': token}
+    return kwargs
+
+# Function to send a request to the backend through the shared session.
+# With token set, the request is authorized with it, and an expired (by its `exp` claim) or rejected
+# (401) token logs the user out instead of failing call by call.
+# With coalesce=True, identical requests (same method, URL, params, body and token) that are
+# already in flight are not sent again; every caller gets the one response.
+def api_request(method, endpoint, path_params=None, coalesce=False, token=None, **kwargs):
+    url = API_BASE_URL + endpoint.format(**(path_params or {}))
+    kwargs.setdefault('timeout', ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+    if token is not None:
+        expires_at = jwt_expiry(token)
+        if expires_at is not None and expires_at <= time.time():
+            reject_token(token)
+        kwargs = authorize_request(token, kwargs)
+    if not coalesce:
+        response = send_request(method, url, endpoint=endpoint, **kwargs)
+    else:
+        def send():
+            response = send_request(method, url, endpoint=endpoint, **kwargs)
+            response.content  # Read the body now so the response can be shared between threads
+            return response
+
+        key = (
+            method, url,
+            session_cache_key(token) if token is not None else None,
+            json.dumps(kwargs.get('params'), sort_keys=True, default=str),
+            json.dumps(kwargs.get('json'), sort_keys=True, default=str),
+        )
+        response = get_single_flight().do(endpoint, key, send)
+    if token is not None and response.status_code == 401:
+        reject_token(token)
+    return response
+
+# Function to send one request under the client policy: fail fast while the circuit is open,
+# and retry idempotent GETs on connection errors, timeouts and gateway errors with jittered backoff
+def send_request(method, url, endpoint=None, **kwargs):
+    breaker = get_circuit_breaker()
+    attempts = max(1, RETRY_ATTEMPTS) if method == 'GET' else 1
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise BackendUnavailable(f"Backend unavailable, retrying in {breaker.retry_in():.0f}s")
+        record('http_calls', endpoint=endpoint or url)
+        try:
+            response = get_http_session().request(method, url, **kwargs)
+            content_length = response.headers.get('Content-Length')
+            if content_length is not None:
+                record('http_bytes', int(content_length))
+            elif not kwargs.get('stream'):
+                record('http_bytes', len(response.content))
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            breaker.record_failure()
+            record('http_errors', endpoint=endpoint or url)
+            if attempt == attempts - 1:
+                raise
+        except BaseException:
+            # Any other error (a body cut off mid-read, an undecodable body) is not retried, but still
+            # counts: a half-open breaker whose trial call ends here would otherwise never close or reopen
+            breaker.record_failure()
+            record('http_errors', endpoint=endpoint or url)
+            raise
+        else:
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                return response
+            response.close()
+        time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+
 # Function to get the JWT token
+@timed
 def get_jwt_token(username, password):
-    response = requests.post(API_BASE_URL + LOGIN_ENDPOINT, json={
-        'username': username,
-        'password': password
-    })
-    print(response.json())
+    try:
+        response = api_request('POST', LOGIN_ENDPOINT, json={
+            'username': username,
+            'password': password
+        })
+    except requests.exceptions.RequestException as e:
+        st.error(f"Login failed: {e}")
+        return None
     if response.status_code == 200:
-        return response.json()['access_token']
+        try:
+            return response.json()['access_token']
+        except (ValueError, KeyError):
+            st.error("Login failed: unexpected response from the server.")
+            return None
     else:
         st.error("Login failed!")
         return None
 
 # Function to sign up a new user
+@timed
 def sign_up(username, password):
-    response = requests.post(API_BASE_URL + SIGN_UP_ENDPOINT, json={
-        'username': username,
-        'password': password
-    })
+    try:
+        response = api_request('POST', SIGN_UP_ENDPOINT, json={
+            'username': username,
+            'password': password
+        })
+    except requests.exceptions.RequestException as e:
+        st.error(f"Sign up failed: {e}")
+        return
     if response.status_code == 200:
         st.write("Sign up successful! Please log in.")
         st.session_state['signup_success'] = True
@@ -51,10 +1426,20 @@ def sign_up(username, password):
         st.error("Sign up failed!")
 
 # Function to get session history
+@timed
 def get_session_history(token):
-    response = requests.get(API_BASE_URL + SESSION_HISTORY_ENDPOINT, params={
-        'token': token
-    })
+    cached = get_session_cache().get(session_cache_key(token, 'history'))
+    if cached is not None:
+        return cached
+    try:
+        response = api_request('GET', SESSION_HISTORY_ENDPOINT, coalesce=True, token=token)
+    except requests.exceptions.RequestException as e:
+        stale = get_session_cache().get_stale(session_cache_key(token, 'history'))
+        if stale is not None:
+            report_warning(f"Showing cached session history: {e}")
+            return stale
+        report_error(f"Failed to retrieve session history: {e}")
+        return []
     if response.status_code == 200:
         try:
             # Parse JSON response
@@ -63,95 +1448,495 @@ def get_session_history(token):
             # Check if 'sessions' key exists and is a list
             sessions = data.get('sessions', [])
             if not isinstance(sessions, list):
-                st.error("Invalid format for sessions.")
+                report_error("Invalid format for sessions.")
                 return []
 
             # Extract session IDs
             session_ids = [session.get('session_id') for session in sessions if isinstance(session, dict)]
+            # Keyed by str(session_id) so the mapping survives serialization by the cache backend
+            titles = {
+                str(session.get('session_id')): session.get('title') or session.get('first_message') or ''
+                for session in sessions if isinstance(session, dict)
+            }
+            get_session_cache().set(session_cache_key(token, 'history'), session_ids)
+            get_session_cache().set(session_cache_key(token, 'titles'), titles)
             return session_ids
 
         except ValueError as e:
-            st.error("Failed to parse JSON response.")
+            report_error("Failed to parse JSON response.")
             return []
     else:
-        st.error("Failed to retrieve session history.")
+        report_error("Failed to retrieve session history.")
         return []
 
+# Function to get the session titles sent along with the session history, if the backend has any
+def get_session_titles(token):
+    return get_session_cache().get(session_cache_key(token, 'titles')) or {}
+
+# Function to get the sidebar search index: (session_id, title, search text) entries, newest session first.
+# Rebuilt only when the cached session history changes.
+def get_session_search_index(token, session_ids):
+    key = (token, hash(tuple(session_ids)))
+    cached = st.session_state.get('session_search_index')
+    if cached and cached[0] == key:
+        return cached[1]
+    titles = get_session_titles(token)
+    first_queries = get_message_store().first_queries(session_ids)
+    index = []
+    for session_id in reversed(session_ids):
+        title = titles.get(str(session_id)) or first_queries.get(str(session_id)) or ''
+        index.append((session_id, title, f"{session_id} {title}".lower()))
+    st.session_state['session_search_index'] = (key, index)
+    return index
+
+# Function to filter the search index; every word of the query has to match
+def search_sessions(index, query):
+    terms = query.lower().split()
+    if not terms:
+        return index
+    return [entry for entry in index if all(term in entry[2] for term in terms)]
+
 # Function to get session messages by ID
+@timed
 def get_session_by_id(session_id, token):
-    response = requests.get(API_BASE_URL + SESSION_BY_ID_ENDPOINT.format(session_id=session_id), params={
-        'token': token
-    })
+    cached = get_session_cache().get(session_cache_key(token, 'session', session_id))
+    if cached is not None:
+        return cached
+    return sync_session(session_id, token)
+
+# Function to fetch a session's new messages (all of them when the store has none), merge them into the
+# local store and cache the result. Identical syncs already in flight are joined when `coalesce` is set.
+def sync_session(session_id, token, coalesce=True):
+    store = get_message_store()
+    params = {}
+    since = store.count(session_id) if INCREMENTAL_SYNC else 0
+    if since:
+        params['since'] = since
+    try:
+        response = api_request('GET', SESSION_BY_ID_ENDPOINT, path_params={'session_id': session_id},
+                               coalesce=coalesce, token=token, params=params)
+    except requests.exceptions.RequestException as e:
+        stale = get_session_cache().get_stale(session_cache_key(token, 'session', session_id)) or store.load(session_id)
+        if stale is not None:
+            report_warning(f"Showing cached conversation: {e}")
+            return stale
+        report_error(f"Failed to retrieve session details: {e}")
+        return []
     if response.status_code == 200:
-        return response.json()
+        session_details = merge_session_details(store, session_id, response.json(), since)
+        get_session_cache().set(session_cache_key(token, 'session', session_id), session_details)
+        return session_details
     else:
-        st.error("Failed to retrieve session details.")
+        report_error("Failed to retrieve session details.")
         return []
 
+# Function to merge a (full or delta) session response into the local message store
+def merge_session_details(store, session_id, data, since):
+    conversation = data.get('conversation', [])
+    # A backend that supports incremental sync echoes `since` and only sends the newer messages;
+    # anything else is a full conversation and replaces the local copy
+    if since and data.get('since') == since:
+        store.save(session_id, data, conversation, start=since)
+    else:
+        store.save(session_id, data, conversation)
+    return store.load(session_id)
+
 # Function to query location
+@timed
 def query_location(longitude, latitude, token, session_id=None, question=None):
     data = {
         'latitude': latitude,
         'longitude': longitude,
-        'token': token,
     }
     if session_id:
         data['session_id'] = session_id
     if question:
         data['question'] = question
-    response = requests.post(API_BASE_URL + QUERY_LOCATION_ENDPOINT, json=data)
+    try:
+        response = api_request('POST', QUERY_LOCATION_ENDPOINT, coalesce=True, token=token, json=data)
+    except requests.exceptions.RequestException as e:
+        report_error(f"Failed to query location: {e}")
+        return None
     if response.status_code == 200:
+        invalidate_session_cache(token, session_id)
         return response.json()
     else:
-        st.error("Failed to query location.")
+        report_error("Failed to query location.")
         return None
 
 # Function to query place
+@timed
 def query_place(place_name, token, session_id, question=None):
     data = {
         'place_name': place_name,
-        'token': token,
         'session_id': session_id
     }
     if question:
         data['question'] = question
-    response = requests.post(API_BASE_URL + QUERY_PLACE_ENDPOINT, json=data)
+    try:
+        response = api_request('POST', QUERY_PLACE_ENDPOINT, coalesce=True, token=token, json=data)
+    except requests.exceptions.RequestException as e:
+        report_error(f"Failed to query place: {e}")
+        return None
     if response.status_code == 200:
+        invalidate_session_cache(token, session_id)
         return response.json()
     else:
-        st.error("Failed to query place.")
+        report_error("Failed to query place.")
         return None
     
+@timed
 def query_ai(query, token, session_id=None):
     data = {
         'query': query,
-        'token': token,
         'session_id': session_id if session_id else ''
     }
-    print("Request data:", data)
+    log_event(logging.DEBUG, 'query_ai.request', session_id=session_id, query_chars=len(query))
     try:
-        response = requests.post(f"{API_BASE_URL}/query_ai", json=data)
+        response = api_request('POST', QUERY_AI_ENDPOINT, token=token, json=data)
         response.raise_for_status()  # Raise an exception for HTTP errors
+        invalidate_session_cache(token, session_id)
         return response.json()
     except requests.exceptions.RequestException as e:
         st.error(f"Failed to query AI: {e}")
         return None
 
+# Function to query the AI and stream the answer while it is generated.
+# Yields text chunks for st.write_stream and fills `result` with the final 'session_id' and 'response'.
+# Understands server-sent events, chunked plain text, and falls back to the blocking JSON response.
+def stream_query_ai(query, token, session_id=None, result=None):
+    result = {} if result is None else result
+    data = {
+        'query': query,
+        'session_id': session_id if session_id else ''
+    }
+    try:
+        response = api_request('POST', QUERY_AI_ENDPOINT, token=token, json=data, stream=True, headers={
+            'Accept': 'text/event-stream, text/plain, application/json'
+        })
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        st.error(f"Failed to query AI: {e}")
+        return
+    result['session_id'] = response.headers.get('X-Session-Id') or session_id
+    content_type = response.headers.get('Content-Type', '')
+    parts = []
+    try:
+        with response:
+            if content_type.startswith('text/event-stream'):
+                for payload in iter_sse_data(response):
+                    if payload == '[DONE]':
+                        break
+                    try:
+                        event = json.loads(payload)
+                    except ValueError:
+                        event = payload
+                    if not isinstance(event, dict):
+                        parts.append(str(event))
+                        yield str(event)
+                        continue
+                    if event.get('session_id'):
+                        result['session_id'] = event['session_id']
+                    if event.get('token'):
+                        parts.append(event['token'])
+                        yield event['token']
+                    if event.get('response') is not None:
+                        # Final event carries the whole answer; trust it over the concatenated tokens
+                        parts = [event['response']]
+            elif content_type.startswith('text/plain'):
+                response.encoding = response.encoding or 'utf-8'
+                for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                    if chunk:
+                        parts.append(chunk)
+                        yield chunk
+            else:
+                body = response.json()
+                result['session_id'] = body.get('session_id') or result['session_id']
+                answer = body.get('response')
+                if answer is None:
+                    return
+                parts.append(answer)
+                yield answer
+    except (requests.exceptions.RequestException, ValueError) as e:
+        st.error(f"Failed to query AI: {e}")
+        return
+    result['response'] = ''.join(parts)
+
+# Function to split a server-sent events body into the `data` payload of each event
+def iter_sse_data(response):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    buffer = ''
+    data_lines = []
+    for chunk in response.iter_content(chunk_size=None):
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            line = line.rstrip('\r')
+            if not line:
+                if data_lines:
+                    yield '\n'.join(data_lines)
+                    data_lines = []
+            elif line.startswith('data:'):
+                data_lines.append(line[5:].lstrip(' '))
+    if data_lines:
+        yield '\n'.join(data_lines)
+
+# Function to resync a session after a chat exchange. The local store is addressed by the backend's
+# message index, so the exchange is not written to it. Instead the cached conversation gets an
+# optimistic copy with the exchange appended, which the next rerun shows without waiting, and a delta
+# sync (since=<local count>) in the background replaces it with the backend's conversation. It is not
+# joined with a sync already in flight, which may have been sent before the backend had the exchange.
+def resync_session(token, session_id, exchange=None, new_session=False):
+    if new_session:
+        invalidate_session_cache(token)
+    cache = get_session_cache()
+    key = session_cache_key(token, 'session', session_id)
+    shown = cache.get(key) if exchange is not None else None
+    if shown:
+        cache.set(key, {**shown, 'conversation': [*shown.get('conversation', []), exchange]})
+    else:
+        cache.delete(key)
+    get_executor().submit(sync_session, session_id, token, coalesce=False)
+
+# Function to send a chat message and render the answer as it streams in
+def send_chat_message(user_input, token, session_id=None):
+    st.markdown(chat_message_html('user', user_input), unsafe_allow_html=True)
+    result = {}
+    st.write_stream(stream_query_ai(user_input, token, session_id, result))
+    new_session_id = result.get('session_id')
+    if not new_session_id:
+        return None
+    exchange = {'query': user_input, 'response': result['response']} if 'response' in result else None
+    resync_session(token, new_session_id, exchange, new_session=not session_id)
+    return new_session_id
+
 # Function to get all places
+@timed
 def get_all_places(session_id, token):
-    response = requests.get(API_BASE_URL + GET_ALL_PLACES_ENDPOINT.format(session_id=session_id), params={
-        'token': token
-    })
+    try:
+        response = api_request('GET', GET_ALL_PLACES_ENDPOINT, path_params={'session_id': session_id}, coalesce=True,
+                               token=token)
+    except requests.exceptions.RequestException as e:
+        log_event(logging.WARNING, 'get_all_places.failed', session_id=session_id, error=str(e))
+        return {}
     
     if response.status_code == 200:
         data = response.json()
-        print("Data fetched:", data)  # Add this line for debugging
+        log_event(logging.DEBUG, 'get_all_places.fetched', session_id=session_id, places=len(data.get('places', [])))
         return data
     else:
-        # Print error details for debugging
-        print(f"Failed to get all places. Status code: {response.status_code}, Response: {response.text}")
+        log_event(logging.WARNING, 'get_all_places.failed', session_id=session_id, status=response.status_code,
+                  body=response.text[:200])
         return {}
 
+# Function to find the places around a point: answered from the geo cache when a nearby query
+# already ran, otherwise by query_location followed by get_all_places.
+# Returns (location_data, all_places_data); location_data is None when the location query failed.
+def fetch_places_near(longitude, latitude, token, session_id, refresh_session=True):
+    geo_cache = get_geo_cache()
+    cached_places = geo_cache.lookup(latitude, longitude, GEO_CACHE_RADIUS_KM)
+    if cached_places is not None:
+        return {'latitude': latitude, 'longitude': longitude, 'cached': True}, {'places': cached_places}
+    # get_all_places returns the places of the last location query on the session, so the pair runs
+    # alone on it: concurrent queries on one session (route waypoints) would get each other's places
+    with get_session_locks().get(session_id):
+        # The query that held the lock before may have covered this point
+        cached_places = geo_cache.lookup(latitude, longitude, GEO_CACHE_RADIUS_KM)
+        if cached_places is not None:
+            return {'latitude': latitude, 'longitude': longitude, 'cached': True}, {'places': cached_places}
+        location_data = query_location(longitude, latitude, token, session_id)
+        if not location_data:
+            return None, None
+        # query_location invalidated the session details; refresh them while the places are fetched
+        if refresh_session:
+            get_executor().submit(get_session_by_id, session_id, token)
+        all_places_data = get_all_places(session_id, token)
+        if all_places_data and all_places_data.get('places'):
+            geo_cache.put(latitude, longitude, all_places_data['places'])
+    return location_data, all_places_data
+
+# Function to read the (latitude, longitude) points of an uploaded GPX or CSV track
+def parse_track(name, data):
+    if name.lower().endswith('.gpx'):
+        root = ElementTree.fromstring(data)
+        points = []
+        for element in root.iter():
+            if element.tag.rsplit('}', 1)[-1] not in ('trkpt', 'rtept', 'wpt'):
+                continue
+            try:
+                points.append((float(element.get('lat')), float(element.get('lon'))))
+            except (TypeError, ValueError):
+                continue
+        return points
+    reader = csv.reader(io.StringIO(data.decode('utf-8-sig')))
+    rows = [row for row in reader if row]
+    if not rows:
+        return []
+    header = [column.strip().lower() for column in rows[0]]
+    lat_column = next((header.index(c) for c in ('latitude', 'lat') if c in header), None)
+    lon_column = next((header.index(c) for c in ('longitude', 'lon', 'lng') if c in header), None)
+    if lat_column is None or lon_column is None:
+        # No recognised header: assume latitude,longitude columns
+        lat_column, lon_column = 0, 1
+    else:
+        rows = rows[1:]
+    points = []
+    for row in rows:
+        try:
+            points.append((float(row[lat_column]), float(row[lon_column])))
+        except (IndexError, ValueError):
+            continue
+    return points
+
+# Function to thin a track to waypoints at least `spacing_km` apart, dropping points that are
+# within `spacing_km` of an earlier waypoint (out-and-back and loop sections)
+def thin_track(points, spacing_km):
+    waypoints = []
+    for latitude, longitude in points:
+        if not (validate_latitude(latitude) and validate_longitude(longitude)):
+            continue
+        if any(haversine_km(latitude, longitude, lat, lon) < spacing_km for lat, lon in waypoints):
+            continue
+        waypoints.append((latitude, longitude))
+    return waypoints
+
+# Function to query places along a route on the shared thread pool, at most ROUTE_MAX_CONCURRENCY
+# waypoints at once and rate limited. Waypoints are looked up in the geo cache concurrently; the backend
+# queries of one session run one at a time. Closing the generator (the user reran or left the page)
+# cancels the waypoints not started yet.
+# Yields (done, total, places) each time a waypoint finishes; `places` is the merged, de-duplicated list so far.
+def fetch_route_places(waypoints, token, session_id):
+    limiter = RateLimiter(ROUTE_RATE_LIMIT)
+    places = []
+    seen = set()
+
+    def fetch(latitude, longitude):
+        cached_places = get_geo_cache().lookup(latitude, longitude, GEO_CACHE_RADIUS_KM)
+        if cached_places is not None:
+            return cached_places
+        limiter.acquire()
+        _, all_places_data = fetch_places_near(longitude, latitude, token, session_id, refresh_session=False)
+        return (all_places_data or {}).get('places', [])
+
+    executor = get_executor()
+    queued = iter(waypoints)
+    running = set()
+    done = 0
+    try:
+        while True:
+            for latitude, longitude in itertools.islice(queued, max(1, ROUTE_MAX_CONCURRENCY) - len(running)):
+                running.add(executor.submit(fetch, latitude, longitude))
+            if not running:
+                return
+            finished, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done += 1
+                try:
+                    new_places = future.result()
+                except Exception as e:
+                    report_error(f"Failed to query a route waypoint: {e}")
+                    new_places = []
+                for place in new_places:
+                    key = (place.get('name'), place.get('latitude'), place.get('longitude'))
+                    if key not in seen:
+                        seen.add(key)
+                        places.append(place)
+                yield done, len(waypoints), places
+    finally:
+        for future in running:
+            future.cancel()
+
+# Function to start fetching details of the places nearest to the queried point in the background
+def start_place_prefetch(place_store, latitude, longitude, token, session_id):
+    cancel_place_prefetch()
+    executor = get_executor()
+    st.session_state['place_prefetch'] = {
+        place_store.names[row]: executor.submit(fetch_place_details, place_store.names[row], token, session_id)
+        for row in place_store.nearest(latitude, longitude, PLACE_PREFETCH_COUNT)
+    }
+
+# Function to drop prefetched place details; calls that have not started yet are cancelled
+def cancel_place_prefetch():
+    for future in st.session_state.pop('place_prefetch', {}).values():
+        future.cancel()
+
+# Function to query a place and keep the answer in the place details cache
+def fetch_place_details(place_name, token, session_id):
+    # query_place writes to the session like query_location: never alongside another call on it
+    with get_session_locks().get(session_id):
+        response = query_place(place_name, token, session_id)
+    if response:
+        get_place_cache().set(session_cache_key(token, 'place', session_id, place_name), response)
+    return response
+
+# Function to get place details: from the place cache, from a prefetch, or from the backend
+def get_place_details(place_name, token, session_id):
+    cached = get_place_cache().get(session_cache_key(token, 'place', session_id, place_name))
+    if cached is not None:
+        return cached
+    future = st.session_state.get('place_prefetch', {}).get(place_name)
+    if future is not None and not future.cancelled():
+        response = future.result()
+        if response:
+            return response
+    return fetch_place_details(place_name, token, session_id)
+
+# Function to get the first picture of a place, if it has any
+def place_picture(place):
+    pictures = place.get('pictures') or []
+    return pictures[0] if pictures else None
+
+# Function to render the places map to HTML; cached by places digest and centre, so reruns reuse it
+@st.cache_data(max_entries=32, show_spinner=False)
+def build_map_html(digest, latitude, longitude, tiles, _place_store):
+    # Imported here, on the first map drawn: importing folium takes longer than the rest of the script,
+    # and the login page never needs it
+    import folium
+    from folium.plugins import FastMarkerCluster
+
+    record('map_builds')
+    thumbnails = get_thumbnail_cache()
+    if thumbnails is not None:
+        thumbnails.schedule(_place_store.pictures)
+    if tiles:
+        location_map = folium.Map(location=[latitude, longitude], zoom_start=10, tiles=tiles, attr=TILE_ATTRIBUTION)
+    else:
+        location_map = folium.Map(location=[latitude, longitude], zoom_start=10)
+    rows = zip(_place_store.latitudes.tolist(), _place_store.longitudes.tolist(),
+               _place_store.names, _place_store.pictures)
+    if len(_place_store) > MAP_CLUSTER_THRESHOLD:
+        FastMarkerCluster(
+            data=[
+                [lat, lon, escape_html(name), escape_html(thumbnail_url(picture)) if picture else '',
+                 escape_html(json.dumps(picture or ''))]
+                for lat, lon, name, picture in rows
+            ],
+            callback=LAZY_POPUP_MARKER_JS,
+        ).add_to(location_map)
+    else:
+        for lat, lon, name, picture in rows:
+            popup_html = f'<b>{escape_html(name)}</b>'
+            if picture:
+                popup_html += (
+                    f'<br><img src="{escape_html(thumbnail_url(picture))}" width="100" '
+                    f'onerror="this.onerror=null;this.src={escape_html(json.dumps(picture))}">'
+                )
+            folium.Marker(
+                location=[lat, lon],
+                popup=folium.Popup(popup_html, max_width=300, lazy=True),
+                icon=folium.Icon(color='blue')
+            ).add_to(location_map)
+    figure = folium.Figure().add_child(location_map)
+    return figure.render()
+
+# Function to show the places map
+def render_places_map(place_store, latitude, longitude):
+    from streamlit.components.v1 import html
+
+    with perf_span('map_render'):
+        html(build_map_html(place_store.digest, latitude, longitude, map_tile_url(), place_store),
+             height=MAP_HEIGHT + 10, width=MAP_WIDTH)
+
 # Authentication page
 def authentication_page():
     # Apply custom CSS for styling
@@ -228,6 +2013,8 @@ def authentication_page():
     # Login Tab
     with tab1:
         st.markdown('<div class="subheader">Login</div>', unsafe_allow_html=True)
+        if 'auth_notice' in st.session_state:
+            st.info(st.session_state.pop('auth_notice'))
         with st.container():
             with st.form(key='login_form', clear_on_submit=True):
                 username = st.text_input('Username', key='login')
@@ -237,6 +2024,7 @@ def authentication_page():
                     token = get_jwt_token(username, password)
                     if token:
                         st.session_state['token'] = token
+                        st.session_state.pop('token_refresh_after', None)
                         st.session_state['selected_session_id'] = None
                         st.session_state['username'] = username
                         st.success("Login successful!")
@@ -257,312 +2045,482 @@ def authentication_page():
                         st.session_state['signup_success'] = False
                         st.rerun()
 
+CHAT_PAGE_CSS = """
+    <style>
+    .sidebar {
+        padding: 20px;
+        background: #4caf50; /* Solid green background */
+        border-right: 1px solid #388e3c; /* Darker green border */
+        height: 100vh;
+        overflow-y: auto;
+        font-family: Arial, sans-serif; /* Modern font */
+    }
+    .sidebar-username {
+        padding: 15px;
+        border-radius: 12px;
+        background: #ffffff; /* White background for username */
+        color: #4caf50; /* Fresh green color for text */
+        font-size: 20px;
+        font-weight: bold;
+        text-align: center;
+        margin-bottom: 20px; /* Space for logout button */
+        box-shadow: 0 4px 8px rgba(0,0,0,0.1); /* Subtle shadow */
+        border: 1px solid #4caf50; /* Matching border */
+    }
+    .sidebar-button {
+        background-color: #ffffff; /* White background for buttons */
+        border: 1px solid #b0bec5; /* Light grey border */
+        border-radius: 8px;
+        padding: 10px;
+        margin: 5px 0;
+        cursor: pointer;
+        text-align: center;
+        color: #333;
+        font-weight: bold;
+        transition: all 0.3s;
+        box-shadow: 0 2px 4px rgba(0,0,0,0.1); /* Subtle shadow */
+    }
+    .sidebar-button:hover {
+        background-color: #f5f5f5; /* Light grey on hover */
+    }
+    .sidebar-button.selected {
+        background-color: #388e3c; /* Dark green for selected session */
+        color: #ffffff;
+        border-color: #388e3c;
+    }
+    .logout-button {
+        background-color: #ff7e5f; /* Solid orange background */
+        border: 1px solid #ffffff;
+        border-radius: 10px;
+        color: #ffffff;
+        padding: 12px;
+        cursor: pointer;
+        font-size: 16px;
+        margin-top: 20px; /* Space above logout button */
+        box-shadow: 0px 4px 6px rgba(0, 0, 0, 0.1); /* Subtle shadow */
+        transition: background-color 0.3s;
+        width: calc(100% - 20px); /* Full width minus padding */
+        text-align: center;
+    }
+    .logout-button:hover {
+        background-color: #feb47b; /* Lighter orange on hover */
+    }
+    .welcome-container {
+        text-align: center;
+        background: #ffffff; /* White background */
+        padding: 20px;
+        border-radius: 12px;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1); /* Subtle shadow */
+        color: #4caf50;
+        margin-bottom: 20px; /* Space below the container */
+    }
+    .username {
+        font-size: 1.8em;
+        font-weight: bold;
+        color: #4caf50;
+        margin-top: 10px;
+        border: 2px solid #4caf50;
+        padding: 10px;
+        border-radius: 8px;
+        display: inline-block;
+        background: rgba(0, 0, 0, 0.05); /* Light background */
+    }
+    .chat-box {
+        display: flex;
+        flex-direction: column;
+        max-height: 600px;
+        overflow-y: auto;
+        padding: 10px;
+        border: 1px solid #ddd;
+        border-radius: 8px;
+        background-color: #f9f9f9;
+    }
+    .chat-conversation {
+        display: flex;
+        flex-direction: column;
+    }
+    .chat-message {
+        margin: 5px 0;
+        padding: 10px;
+        border-radius: 10px;
+        background-color: #ffffff;
+        box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
+        position: relative;
+        max-width: 75%;
+    }
+    .chat-message.ai {
+        background-color: #e0f7fa;
+        align-self: flex-start;
+    }
+    .chat-message.user {
+        background-color: #c8e6c9;
+        align-self: flex-end;
+        border-radius: 10px 10px 0 10px;
+    }
+    .chat-message::before {
+        content: '';
+        position: absolute;
+        width: 0;
+        height: 0;
+        border: 10px solid transparent;
+    }
+    .chat-message.ai::before {
+        border-right-color: #e0f7fa;
+        top: 10px;
+        left: -10px;
+        border-width: 10px 10px 10px 0;
+    }
+    .chat-message.user::before {
+        border-left-color: #c8e6c9;
+        top: 10px;
+        right: -10px;
+        border-width: 10px 0 10px 10px;
+    }
+    </style>
+    """
+
 def chat_page():
     st.title('Tourism Assistant')
     if 'token' in st.session_state:
-        token = st.session_state['token']
+        session_token()
         selected_session_id = st.session_state.get('selected_session_id', None)
         username = st.session_state['username']  # Ensure you have the username in session state
 
-        st.markdown("""
-        <style>
-        .sidebar {
-            padding: 20px;
-            background: #4caf50; /* Solid green background */
-            border-right: 1px solid #388e3c; /* Darker green border */
-            height: 100vh;
-            overflow-y: auto;
-            font-family: Arial, sans-serif; /* Modern font */
-        }
-        .sidebar-username {
-            padding: 15px;
-            border-radius: 12px;
-            background: #ffffff; /* White background for username */
-            color: #4caf50; /* Fresh green color for text */
-            font-size: 20px;
-            font-weight: bold;
-            text-align: center;
-            margin-bottom: 20px; /* Space for logout button */
-            box-shadow: 0 4px 8px rgba(0,0,0,0.1); /* Subtle shadow */
-            border: 1px solid #4caf50; /* Matching border */
-        }
-        .sidebar-button {
-            background-color: #ffffff; /* White background for buttons */
-            border: 1px solid #b0bec5; /* Light grey border */
-            border-radius: 8px;
-            padding: 10px;
-            margin: 5px 0;
-            cursor: pointer;
-            text-align: center;
-            color: #333;
-            font-weight: bold;
-            transition: all 0.3s;
-            box-shadow: 0 2px 4px rgba(0,0,0,0.1); /* Subtle shadow */
-        }
-        .sidebar-button:hover {
-            background-color: #f5f5f5; /* Light grey on hover */
-        }
-        .sidebar-button.selected {
-            background-color: #388e3c; /* Dark green for selected session */
-            color: #ffffff;
-            border-color: #388e3c;
-        }
-        .logout-button {
-            background-color: #ff7e5f; /* Solid orange background */
-            border: 1px solid #ffffff;
-            border-radius: 10px;
-            color: #ffffff;
-            padding: 12px;
-            cursor: pointer;
-            font-size: 16px;
-            margin-top: 20px; /* Space above logout button */
-            box-shadow: 0px 4px 6px rgba(0, 0, 0, 0.1); /* Subtle shadow */
-            transition: background-color 0.3s;
-            width: calc(100% - 20px); /* Full width minus padding */
-            text-align: center;
-        }
-        .logout-button:hover {
-            background-color: #feb47b; /* Lighter orange on hover */
-        }
-        .welcome-container {
-            text-align: center;
-            background: #ffffff; /* White background */
-            padding: 20px;
-            border-radius: 12px;
-            box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1); /* Subtle shadow */
-            color: #4caf50;
-            margin-bottom: 20px; /* Space below the container */
-        }
-        .username {
-            font-size: 1.8em;
-            font-weight: bold;
-            color: #4caf50;
-            margin-top: 10px;
-            border: 2px solid #4caf50;
-            padding: 10px;
-            border-radius: 8px;
-            display: inline-block;
-            background: rgba(0, 0, 0, 0.05); /* Light background */
-        }
-        </style>
-        """, unsafe_allow_html=True)
+        # Styles are sent once per full run; fragment reruns below only resend their own region
+        st.markdown(CHAT_PAGE_CSS, unsafe_allow_html=True)
 
         with st.sidebar:
-            # Display username and logout button
-            st.markdown("""
-            <div class="welcome-container">
-                <h1>Welcome!</h1>
-                <div class="username">{username}</div>
-            </div>
-            """.format(username=username), unsafe_allow_html=True)
-
-            # JavaScript to handle logout
-            if st.button('Logout', key='logout', help='Log out of the application', use_container_width=True):
-                st.session_state.clear()  # Clears all session state variables
-                st.rerun()  # Refresh the page
-
-            # Display chat history
-            st.header('Chat History')
-            session_ids = get_session_history(token)
-
-            if st.button('New Chat'):
-                st.session_state['selected_session_id'] = None
-                selected_session_id = None
-                st.session_state['location_query_done'] = False  # Reset location query status
-                st.session_state['all_places_data'] = None  # Clear stored place data
-                st.rerun()
-
-            # Display sessions as a reversed list with styling
-            for session_id in reversed(session_ids):
-                button_class = 'sidebar-button'
-                if session_id == selected_session_id:
-                    button_class += ' selected'
-                if st.button(f"Session {session_id}", key=session_id):
-                    st.session_state['selected_session_id'] = session_id
-                    selected_session_id = session_id
-                    st.session_state['location_query_done'] = False  # Reset location query status
-                    st.session_state['all_places_data'] = None  # Clear stored place data
-                    st.session_state['longitude'] = None
-                    st.session_state['latitude'] = None
-                    st.rerun()
+            sidebar_panel(username)
 
         if selected_session_id:
-            session_details = get_session_by_id(selected_session_id, token)
-            st.session_state['selected_session_id'] = selected_session_id
-
-            # Apply beautiful styling for chat messages
-            st.markdown("""
-            <style>
-            .chat-box {
-                display: flex;
-                flex-direction: column;
-                max-height: 600px;
-                overflow-y: auto;
-                padding: 10px;
-                border: 1px solid #ddd;
-                border-radius: 8px;
-                background-color: #f9f9f9;
-            }
-            .chat-message {
-                margin: 5px 0;
-                padding: 10px;
-                border-radius: 10px;
-                background-color: #ffffff;
-                box-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-                position: relative;
-                max-width: 75%;
-            }
-            .chat-message.ai {
-                background-color: #e0f7fa;
-                align-self: flex-start;
-            }
-            .chat-message.user {
-                background-color: #c8e6c9;
-                align-self: flex-end;
-                border-radius: 10px 10px 0 10px;
-            }
-            .chat-message::before {
-                content: '';
-                position: absolute;
-                width: 0;
-                height: 0;
-                border: 10px solid transparent;
-            }
-            .chat-message.ai::before {
-                border-right-color: #e0f7fa;
-                top: 10px;
-                left: -10px;
-                border-width: 10px 10px 10px 0;
-            }
-            .chat-message.user::before {
-                border-left-color: #c8e6c9;
-                top: 10px;
-                right: -10px;
-                border-width: 10px 0 10px 10px;
-            }
-            </style>
-            """, unsafe_allow_html=True)
-
-            for message in session_details.get('conversation', []):
-                if message['query']:
-                    st.markdown(f'<div class="chat-message user">{message["query"]}</div>', unsafe_allow_html=True)
-                if message['response']:
-                    st.markdown(f'<div class="chat-message ai">{message["response"]}</div>', unsafe_allow_html=True)
-            st.markdown('</div>', unsafe_allow_html=True)
-
-            # Retrieve persisted longitude and latitude
-            longitude = st.session_state.get('longitude', None)
-            latitude = st.session_state.get('latitude', None)
-            all_places_data = st.session_state.get('all_places_data', None)
-
-            # Input for longitude and latitude
-            longitude_input = st.number_input('Longitude', format="%.6f", value=longitude)
-            latitude_input = st.number_input('Latitude', format="%.6f", value=latitude)
-            if latitude_input is not None and not validate_latitude(latitude_input):
-                st.error("🚫 Invalid latitude value. Latitude must be between -90 and 90.")
-            elif longitude_input is not None and not validate_longitude(longitude_input):
-                st.error("🚫 Invalid longitude value. Longitude must be between -180 and 180.")
-            else :
-                if st.button('Query Location'):
-                    if not (longitude_input and latitude_input and token and selected_session_id):
-                        st.error('Please enter longitude, latitude, token, and session ID.')
-                    else:
-                        st.session_state['longitude'] = longitude_input
-                        st.session_state['latitude'] = latitude_input
-                        
-                        st.session_state['location_query_done'] = False
-                        st.session_state['all_places'] = []
-                        st.session_state['location_data'] = None
-                        
-                        # Query locations
-                        location_data = query_location(longitude_input, latitude_input, token, selected_session_id)
-                        if location_data:
-                            st.session_state['location_data'] = location_data
-                            st.session_state['location_query_done'] = True
-                            all_places_data = get_all_places(selected_session_id, token)
-                            st.session_state['all_places_data'] = all_places_data
-                            print(all_places_data)
-                            if all_places_data:
-                                st.session_state['all_places'] = all_places_data.get('places', [])
-                            else:
-                                st.error('No places found for this location.')
-                            st.rerun()
-                        else:
-                            st.error('Failed to fetch location data.')
-
-                # Handling location query
-                if 'location_query_done' in st.session_state and st.session_state['location_query_done'] and all_places_data:
-                    if st.session_state['location_data']:
-
-                        # Display all places on the map
-                        location_map = folium.Map(location=[latitude_input, longitude_input], zoom_start=10)
-                        for place in st.session_state['all_places']:
-                            folium.Marker(
-                                location=[place['latitude'], place['longitude']],
-                                popup=folium.Popup(f'<b>{place["name"]}</b><br><img src="{place["pictures"][0]}" width="100">', max_width=300),
-                                icon=folium.Icon(color='blue')
-                            ).add_to(location_map)
-                        folium_static(location_map)
-
-                        # Query a specific place
-                        st.subheader('Query Place')
-                        place_names = [place['name'] for place in st.session_state['all_places']]
-                        selected_place = st.selectbox('Select a place', place_names)
-                                
-                        if st.button('Query Place') and selected_place:
-                            place = next((p for p in st.session_state['all_places'] if p['name'] == selected_place), None)
-                            if place:
-                                response = query_place(place['name'], token, selected_session_id)
-                                if response:
-                                    st.markdown(f'<div class="chat-message ai">{response}</div>', unsafe_allow_html=True)
-                                else:
-                                    st.error('Failed to fetch place details.')
-                            else:
-                                st.error('Place not found in the list.')
-                # New chat input
-                with st.form(key='new_chat_form'):
-                    user_input = st.text_input('Type your message', '')
-                    submit_button = st.form_submit_button('Send')
-
-                    if submit_button and user_input:
-                        response = query_ai(user_input, token, selected_session_id)
-                        st.rerun()
-
-                    elif submit_button and not user_input:
-                        st.warning("Please enter a message to start the conversation.")
+            conversation_panel(selected_session_id)
+            location_panel(selected_session_id)
+            chat_input_panel(selected_session_id)
 
         else:
             st.info("Start a new chat by entering a message below:")
             st.session_state['longitude']=None
             st.session_state['latitude']=None
             # Display a text input field for new queries
-            with st.form(key='new_chat_form'):
-                user_input = st.text_input('Type your message', '')
-                submit_button = st.form_submit_button('Send')
-
-                if submit_button and user_input:
-                    response = query_ai(user_input, token)
-                    if response:
-                        new_session_id = response.get('session_id', None)
-                        print(new_session_id)
-                        if new_session_id:
-                            st.session_state['selected_session_id'] = new_session_id
-                            st.rerun()
-
-                elif submit_button and not user_input:
-                    st.warning("Please enter a message to start the conversation.")
+            chat_input_panel()
 
     else:
         st.error("You need to be logged in to access this page.")
 
+# Sidebar: username, logout, and the session list. Reruns on its own unless a session is picked.
+@st.fragment
+@perf_fragment
+def sidebar_panel(username):
+    token = session_token()
+    selected_session_id = st.session_state.get('selected_session_id', None)
+
+    # Display username and logout button
+    st.markdown("""
+    <div class="welcome-container">
+        <h1>Welcome!</h1>
+        <div class="username">{username}</div>
+    </div>
+    """.format(username=username), unsafe_allow_html=True)
+
+    # JavaScript to handle logout
+    if st.button('Logout', key='logout', help='Log out of the application', use_container_width=True):
+        invalidate_token_cache(token)
+        st.session_state.clear()  # Clears all session state variables
+        st.rerun()  # Refresh the page
+
+    # Display chat history
+    st.header('Chat History')
+    session_ids = get_session_history(token)
+
+    if st.button('New Chat'):
+        invalidate_session_cache(token)
+        cancel_place_prefetch()
+        st.session_state['selected_session_id'] = None
+        st.session_state['location_query_done'] = False  # Reset location query status
+        st.session_state['place_store'] = None  # Clear stored place data
+        st.rerun()
+
+    # Display sessions newest first, one page at a time, filtered by the search box
+    search = st.text_input('Search sessions', key='session_search', placeholder='Session ID or first message',
+                           on_change=lambda: st.session_state.pop('session_list_limit', None))
+    matches = search_sessions(get_session_search_index(token, session_ids), search)
+    limit = st.session_state.get('session_list_limit', SIDEBAR_PAGE_SIZE)
+    for session_id, title, _ in matches[:limit]:
+        button_class = 'sidebar-button'
+        if session_id == selected_session_id:
+            button_class += ' selected'
+        label = f"Session {session_id}" + (f" · {title[:40]}" if title else '')
+        if st.button(label, key=session_id):
+            cancel_place_prefetch()
+            st.session_state['selected_session_id'] = session_id
+            st.session_state['location_query_done'] = False  # Reset location query status
+            st.session_state['place_store'] = None  # Clear stored place data
+            st.session_state['longitude'] = None
+            st.session_state['latitude'] = None
+            st.rerun()
+    if len(matches) > limit:
+        st.button(f"Load more ({len(matches) - limit} more)", key='session_list_more',
+                  on_click=lambda: st.session_state.update(session_list_limit=limit + SIDEBAR_PAGE_SIZE))
+    elif search and not matches:
+        st.caption('No sessions match your search.')
+
+    breaker = get_circuit_breaker()
+    if breaker.state != 'closed':
+        st.caption(f"Backend unavailable ({breaker.state}), serving cached data")
+    expires_at = jwt_expiry(token)
+    if expires_at is not None and expires_at - time.time() <= TOKEN_REFRESH_MARGIN:
+        st.warning(f"Your session expires in {max(0, int(expires_at - time.time()))} seconds. "
+                   "Log out and log in again to continue.")
+
+# Performance panel: the last reruns with their spans and counters, cache and coalescing totals,
+# and downloads of the process metrics (Prometheus text) and the rerun history (JSON lines)
+def debug_panel():
+    with st.expander('Performance', expanded=False):
+        history = st.session_state.get('perf_history', [])
+        if history:
+            st.dataframe(
+                [
+                    {
+                        'run': stats['kind'],
+                        'ms': stats['duration_ms'],
+                        'http': sum(value for key, value in stats['counters'].items() if key.startswith('http_calls:')),
+                        'cache hits': sum(value for key, value in stats['counters'].items() if key.startswith('cache_hit:')),
+                        'spans': ', '.join(f'{name} {ms:.0f}ms' for name, ms in stats['spans']),
+                    }
+                    for stats in reversed(history)
+                ],
+                hide_index=True,
+            )
+        else:
+            st.caption('No reruns recorded yet.')
+
+        # Response cache counters, to check how many backend calls the cache saves
+        session_cache = get_session_cache()
+        st.caption(f"Session cache: {session_cache.hits} hits / {session_cache.misses} misses ({len(session_cache)} entries)")
+        geo_cache = get_geo_cache()
+        st.caption(f"Geo cache: {geo_cache.hits} hits / {geo_cache.misses} misses ({len(geo_cache)} tiles)")
+        single_flight = get_single_flight()
+        for endpoint in sorted(single_flight.executed | single_flight.collapsed):
+            collapsed = single_flight.collapsed[endpoint]
+            st.caption(f"Coalesced {endpoint}: {collapsed} of {collapsed + single_flight.executed[endpoint]}")
+
+        st.download_button('Metrics (Prometheus)', get_metrics().prometheus(), file_name='volund_metrics.txt',
+                           mime='text/plain', key='perf_metrics_download')
+        st.download_button('Reruns (JSON lines)', ''.join(rerun_json_line(stats) + '\n' for stats in history),
+                           file_name='volund_reruns.jsonl', mime='application/json', key='perf_reruns_download')
+
+# Function to render one chat bubble; message text is escaped, so backend answers cannot inject markup
+def chat_message_html(role, text):
+    return f'<div class="chat-message {role}">{escape_html(str(text)).replace(chr(10), "<br>")}</div>'
+
+# Function to render one exchange; cached by content, so every message is escaped once per process
+@st.cache_data(max_entries=4096, show_spinner=False)
+def exchange_html(query, response):
+    parts = []
+    if query:
+        parts.append(chat_message_html('user', query))
+    if response:
+        parts.append(chat_message_html('ai', response))
+    return ''.join(parts)
+
+# Function to render the shown messages as one HTML block, sent to the browser as a single element.
+# Cached by session, window size and a digest of the window, so reruns reuse the block until it changes.
+@st.cache_data(max_entries=256, show_spinner=False)
+def conversation_html(session_id, count, digest, _messages):
+    return '<div class="chat-conversation">' + ''.join(
+        exchange_html(message.get('query'), message.get('response')) for message in _messages
+    ) + '</div>'
+
+# Function to hash the shown messages, to key the rendered block
+def conversation_digest(messages):
+    return hashlib.sha1(json.dumps(messages, sort_keys=True, default=str).encode()).hexdigest()
+
+# Conversation of the selected session: the newest CONVERSATION_PAGE_SIZE messages, older ones on demand
+@st.fragment
+@perf_fragment
+def conversation_panel(session_id):
+    token = session_token()
+    session_details = get_session_by_id(session_id, token)
+    conversation = session_details.get('conversation', []) if session_details else []
+    limits = st.session_state.setdefault('conversation_limits', {})
+    limit = limits.get(session_id, CONVERSATION_PAGE_SIZE)
+    if len(conversation) > limit:
+        older = len(conversation) - limit
+        st.button(f"Load older messages ({older} more)", key='conversation_older',
+                  on_click=lambda: limits.update({session_id: limit + CONVERSATION_PAGE_SIZE}))
+    shown = conversation[-limit:]
+    with perf_span('conversation_render'):
+        st.markdown(conversation_html(session_id, len(shown), conversation_digest(shown), shown),
+                    unsafe_allow_html=True)
+
+# Location query, map, and place query. Querying or picking a place only reruns this panel.
+@st.fragment
+@perf_fragment
+def location_panel(selected_session_id):
+    token = session_token()
+    # Retrieve persisted longitude and latitude
+    longitude = st.session_state.get('longitude', None)
+    latitude = st.session_state.get('latitude', None)
+    place_store = st.session_state.get('place_store', None)
+
+    # Input for longitude and latitude
+    longitude_input = st.number_input('Longitude', format="%.6f", value=longitude)
+    latitude_input = st.number_input('Latitude', format="%.6f", value=latitude)
+    if latitude_input is not None and not validate_latitude(latitude_input):
+        st.error("🚫 Invalid latitude value. Latitude must be between -90 and 90.")
+        return
+    elif longitude_input is not None and not validate_longitude(longitude_input):
+        st.error("🚫 Invalid longitude value. Longitude must be between -180 and 180.")
+        return
+
+    # Prefetched place details belong to the previous coordinates
+    if (longitude_input, latitude_input) != (longitude, latitude):
+        cancel_place_prefetch()
+
+    if st.button('Query Location'):
+        if not (longitude_input and latitude_input and token and selected_session_id):
+            st.error('Please enter longitude, latitude, token, and session ID.')
+        else:
+            st.session_state['longitude'] = longitude_input
+            st.session_state['latitude'] = latitude_input
+
+            st.session_state['location_query_done'] = False
+            st.session_state['place_store'] = None
+            st.session_state['location_data'] = None
+            cancel_place_prefetch()
+
+            # Query locations (served from the geo cache when a nearby point was already queried)
+            location_data, all_places_data = fetch_places_near(longitude_input, latitude_input, token, selected_session_id)
+            if location_data:
+                st.session_state['location_data'] = location_data
+                st.session_state['location_query_done'] = True
+                if all_places_data:
+                    place_store = PlaceStore(all_places_data.get('places', []))
+                    st.session_state['place_store'] = place_store
+                    start_place_prefetch(place_store, latitude_input, longitude_input, token, selected_session_id)
+                else:
+                    st.error('No places found for this location.')
+                # The backend added the location exchange to the conversation: rerun the whole page so
+                # the conversation panel shows it (the session is refetched by delta sync)
+                if not location_data.get('cached'):
+                    st.rerun()
+            else:
+                st.error('Failed to fetch location data.')
+
+    route_panel(token, selected_session_id)
+
+    # Handling location query
+    if 'location_query_done' in st.session_state and st.session_state['location_query_done'] and place_store is not None:
+        if st.session_state['location_data']:
+
+            # Display all places on the map
+            render_places_map(place_store, latitude_input, longitude_input)
+
+            # Query a specific place, nearest first
+            st.subheader('Query Place')
+            radius_km = st.number_input('Only places within (km, 0 for all)', min_value=0.0, value=0.0, step=1.0)
+            rows, distances = place_store.ranked(latitude_input, longitude_input, radius_km)
+            selected_place = st.selectbox(
+                'Select a place', [place_store.names[row] for row in rows],
+                format_func=lambda name: f"{name} ({distances[place_store.row(name)]:.1f} km)"
+            )
+
+            if st.button('Query Place') and selected_place:
+                row = place_store.row(selected_place)
+                if row is not None:
+                    response = get_place_details(place_store.names[row], token, selected_session_id)
+                    answer = response.get('response') if isinstance(response, dict) else response
+                    if answer:
+                        st.markdown(chat_message_html('ai', answer), unsafe_allow_html=True)
+                    else:
+                        st.error('Failed to fetch place details.')
+                else:
+                    st.error('Place not found in the list.')
+
+# Route query: upload a track, query every waypoint, and stream the merged places onto the map
+def route_panel(token, selected_session_id):
+    with st.expander('Check a whole route (GPX or CSV track)'):
+        track_file = st.file_uploader('Track file', type=['gpx', 'csv'])
+        spacing_km = st.number_input('Waypoint spacing (km)', min_value=0.1, value=ROUTE_WAYPOINT_SPACING_KM, step=0.5)
+        if not (st.button('Query Route') and track_file):
+            return
+        try:
+            points = parse_track(track_file.name, track_file.getvalue())
+        except (ElementTree.ParseError, UnicodeDecodeError, ValueError) as e:
+            st.error(f'Could not read the track: {e}')
+            return
+        waypoints = thin_track(points, spacing_km)
+        if not waypoints:
+            st.error('No valid points found in the track.')
+            return
+
+        latitude = sum(lat for lat, _ in waypoints) / len(waypoints)
+        longitude = sum(lon for _, lon in waypoints) / len(waypoints)
+        cancel_place_prefetch()
+        progress = st.progress(0.0, text=f'Querying {len(waypoints)} waypoints...')
+        map_placeholder = st.empty()
+        places = []
+        last_refresh = 0.0
+        for done, total, places in fetch_route_places(waypoints, token, selected_session_id):
+            progress.progress(done / total, text=f'Queried {done}/{total} waypoints, {len(places)} places found')
+            if places and (done == total or time.monotonic() - last_refresh >= ROUTE_MAP_REFRESH_SECONDS):
+                last_refresh = time.monotonic()
+                with map_placeholder:
+                    render_places_map(PlaceStore(places), latitude, longitude)
+
+        invalidate_session_cache(token, selected_session_id)
+        if not places:
+            st.error('No places found along this route.')
+            return
+        st.session_state['longitude'] = longitude
+        st.session_state['latitude'] = latitude
+        st.session_state['location_data'] = {'latitude': latitude, 'longitude': longitude, 'route': len(waypoints)}
+        st.session_state['location_query_done'] = True
+        place_store = PlaceStore(places)
+        st.session_state['place_store'] = place_store
+        start_place_prefetch(place_store, latitude, longitude, token, selected_session_id)
+        st.rerun()
+
+# Chat input. Sending a message reruns the whole page, which is served from the session cache.
+@st.fragment
+@perf_fragment
+def chat_input_panel(session_id=None):
+    token = session_token()
+    with st.form(key='new_chat_form'):
+        user_input = st.text_input('Type your message', '')
+        submit_button = st.form_submit_button('Send')
+
+        if submit_button and user_input:
+            new_session_id = send_chat_message(user_input, token, session_id)
+            if not session_id:
+                log_event(logging.DEBUG, 'chat.new_session', session_id=new_session_id)
+                if not new_session_id:
+                    return
+                st.session_state['selected_session_id'] = new_session_id
+            st.rerun()
+
+        elif submit_button and not user_input:
+            st.warning("Please enter a message to start the conversation.")
+
 # Main function
 def main():
     st.set_page_config(page_title='Tourism Application', layout='wide')
+    if BACKEND_WARMUP:
+        start_backend_warmup()
     
-    if 'token' not in st.session_state:
-        authentication_page()
-    else:
-        chat_page()
+    begin_rerun('app')
+    st.session_state['perf_in_app_run'] = True
+    try:
+        if 'token' not in st.session_state:
+            authentication_page()
+        else:
+            chat_page()
+    finally:
+        st.session_state['perf_in_app_run'] = False
+        end_rerun()
+    if perf_debug_enabled():
+        with st.sidebar:
+            debug_panel()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,208 @@
+# Pre-seeds map tiles for offline use: downloads the tiles covering a bounding box, or a radius around
+# queried places, into an MBTiles file or a {z}/{x}/{y}.png directory that run.py serves with TILE_SOURCE.
+#
+#     python seed_tiles.py --around 36.75,3.06 --around 36.19,5.41 --radius-km 15 --zoom 8-15 \
+#         --url 'https://tiles.example.com/{z}/{x}/{y}.png' --output tiles.mbtiles
+#
+# Only seed from a tile provider whose terms allow bulk and offline use; the public OpenStreetMap tile
+# servers do not (https://operations.osmfoundation.org/policies/tiles/).
+import argparse
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+EARTH_RADIUS_KM = 6371.0
+USER_AGENT = 'volund-tourism-app/1.0 (offline tile seeding)'
+# Web Mercator stops at about 85.05 degrees of latitude
+MAX_LATITUDE = 85.0511
+
+# Function to get the x/y of the tile containing a point at zoom level z
+def tile_for(latitude, longitude, z):
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    n = 1 << z
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+# Function to get the bounding box (south, west, north, east) of a radius around a point
+def bbox_around(latitude, longitude, radius_km):
+    delta_latitude = math.degrees(radius_km / EARTH_RADIUS_KM)
+    delta_longitude = math.degrees(radius_km / (EARTH_RADIUS_KM * max(math.cos(math.radians(latitude)), 0.01)))
+    return latitude - delta_latitude, longitude - delta_longitude, latitude + delta_latitude, longitude + delta_longitude
+
+# Function to list the (z, x, y) tiles covering the bounding boxes at every zoom level, without repeats
+def tiles_for(bboxes, zooms):
+    tiles = set()
+    for south, west, north, east in bboxes:
+        for z in zooms:
+            min_x, min_y = tile_for(north, west, z)
+            max_x, max_y = tile_for(south, east, z)
+            tiles.update((z, x, y) for x in range(min_x, max_x + 1) for y in range(min_y, max_y + 1))
+    return sorted(tiles)
+
+# Tiles written to an MBTiles file (rows in TMS order, as the format requires)
+class MBTilesWriter:
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS tiles '
+                                '(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+        self.connection.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+
+    def has(self, z, x, y):
+        return self.connection.execute(
+            'SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?', (z, x, (1 << z) - 1 - y)
+        ).fetchone() is not None
+
+    def write(self, z, x, y, data):
+        self.connection.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)', (z, x, (1 << z) - 1 - y, data))
+
+    def finish(self, bboxes, zooms, tile_format):
+        south = min(bbox[0] for bbox in bboxes)
+        west = min(bbox[1] for bbox in bboxes)
+        north = max(bbox[2] for bbox in bboxes)
+        east = max(bbox[3] for bbox in bboxes)
+        metadata = {
+            'name': 'volund offline tiles',
+            'format': tile_format,
+            'minzoom': str(min(zooms)),
+            'maxzoom': str(max(zooms)),
+            'bounds': f'{west:.6f},{south:.6f},{east:.6f},{north:.6f}',
+        }
+        self.connection.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)', metadata.items())
+        self.connection.commit()
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+# Tiles written to a {z}/{x}/{y}.png directory
+class DirectoryWriter:
+    def __init__(self, path):
+        self.path = path
+
+    def tile_path(self, z, x, y):
+        return os.path.join(self.path, str(z), str(x), f'{y}.png')
+
+    def has(self, z, x, y):
+        return os.path.exists(self.tile_path(z, x, y))
+
+    def write(self, z, x, y, data):
+        path = self.tile_path(z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def finish(self, bboxes, zooms, tile_format):
+        pass
+
+    def commit(self):
+        pass
+
+# Spaces downloads to at most `rate` per second across all worker threads
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+# Function to download one tile; returns its bytes, or None when the server has no such tile
+def download_tile(session, url, z, x, y, limiter):
+    limiter.acquire()
+    response = session.get(url.format(z=z, x=x, y=y), timeout=(3.05, 30))
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.content
+
+# Function to parse "LAT,LON" or "SOUTH,WEST,NORTH,EAST"
+def parse_numbers(count):
+    def parse(value):
+        numbers = [float(part) for part in value.split(',')]
+        if len(numbers) != count:
+            raise argparse.ArgumentTypeError(f'expected {count} comma separated numbers, got {value!r}')
+        return numbers
+    return parse
+
+# Function to parse a zoom level or an inclusive range such as 8-15
+def parse_zooms(value):
+    first, _, last = value.partition('-')
+    zooms = range(int(first), int(last or first) + 1)
+    if not zooms or zooms[0] < 0 or zooms[-1] > 22:
+        raise argparse.ArgumentTypeError(f'invalid zoom range {value!r}')
+    return zooms
+
+def main():
+    parser = argparse.ArgumentParser(description='Download map tiles for offline use by run.py (TILE_SOURCE).')
+    parser.add_argument('--around', type=parse_numbers(2), action='append', default=[], metavar='LAT,LON',
+                        help='a queried place to cover (repeatable)')
+    parser.add_argument('--radius-km', type=float, default=10, help='distance covered around every --around')
+    parser.add_argument('--bbox', type=parse_numbers(4), action='append', default=[], metavar='S,W,N,E',
+                        help='a bounding box to cover (repeatable)')
+    parser.add_argument('--zoom', type=parse_zooms, default=parse_zooms('8-14'), help='zoom level or range')
+    parser.add_argument('--url', default=os.environ.get('TILE_UPSTREAM_URL'),
+                        help='tile URL template with {z}, {x} and {y} (default: $TILE_UPSTREAM_URL)')
+    parser.add_argument('--output', required=True, help='an .mbtiles file, or a directory for {z}/{x}/{y}.png')
+    parser.add_argument('--rate', type=float, default=2, help='downloads per second')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--max-tiles', type=int, default=10000, help='refuse to seed more tiles than this')
+    args = parser.parse_args()
+
+    if not args.url:
+        parser.error('--url (or TILE_UPSTREAM_URL) is required')
+    bboxes = [bbox_around(latitude, longitude, args.radius_km) for latitude, longitude in args.around] + args.bbox
+    if not bboxes:
+        parser.error('give at least one --around or --bbox')
+    tiles = tiles_for(bboxes, args.zoom)
+    if len(tiles) > args.max_tiles:
+        parser.error(f'{len(tiles)} tiles to seed, more than --max-tiles {args.max_tiles}; '
+                     'narrow the area or zoom range, or raise the limit')
+
+    writer = MBTilesWriter(args.output) if args.output.endswith('.mbtiles') else DirectoryWriter(args.output)
+    missing = [tile for tile in tiles if not writer.has(*tile)]
+    print(f'{len(tiles)} tiles cover the area, {len(missing)} to download')
+
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    limiter = RateLimiter(args.rate)
+    tile_format = 'png'
+    downloaded = failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(download_tile, session, args.url, *tile, limiter): tile for tile in missing}
+        for done, future in enumerate(as_completed(futures), 1):
+            tile = futures[future]
+            try:
+                data = future.result()
+            except requests.exceptions.RequestException as e:
+                failed += 1
+                print(f'failed {tile}: {e}', file=sys.stderr)
+                continue
+            if data is None:
+                continue
+            if data.startswith(b'\xff\xd8'):
+                tile_format = 'jpg'
+            writer.write(*tile, data)
+            downloaded += 1
+            if done % 100 == 0:
+                writer.commit()
+                print(f'{done}/{len(missing)}', flush=True)
+    writer.finish(bboxes, args.zoom, tile_format)
+    print(f'Downloaded {downloaded} tiles, {failed} failed')
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# run.py is a script at the repository root, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BACKEND_WARMUP', '0')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
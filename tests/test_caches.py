@@ -0,0 +1,186 @@
+# Tests of the cache backends behind the session, place and geo caches (CACHE_BACKEND)
+import itertools
+
+import pytest
+
+import run
+
+LARGE_VALUE = {'conversation': [{'query': 'q' * 100, 'response': 'r' * 1000}] * 5}
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Every call of time.time() moves one second forward, so access times never tie
+    ticks = itertools.count(1_000_000)
+    monkeypatch.setattr(run.time, 'time', lambda: float(next(ticks)))
+
+@pytest.fixture
+def sqlite_path(tmp_path):
+    return str(tmp_path / 'cache.sqlite3')
+
+@pytest.fixture
+def redis_server():
+    fakeredis = pytest.importorskip('fakeredis')
+    return fakeredis.FakeServer()
+
+def redis_cache(server, namespace='test', maxsize=10, ttl=60):
+    fakeredis = pytest.importorskip('fakeredis')
+    return run.RedisCache(fakeredis.FakeRedis(server=server), namespace, maxsize, ttl)
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def make_cache(request, tmp_path):
+    def make(namespace='test', maxsize=10, ttl=60):
+        if request.param == 'sqlite':
+            return run.SQLiteCache(str(tmp_path / 'cache.sqlite3'), namespace, maxsize, ttl)
+        if request.param == 'redis':
+            return redis_cache(request.getfixturevalue('redis_server'), namespace, maxsize, ttl)
+        return run.TTLCache(namespace, maxsize, ttl)
+    return make
+
+def test_pack_value_round_trip():
+    for value in ({'a': [1, 2.5, None, 'x']}, LARGE_VALUE, []):
+        assert run.unpack_value(run.pack_value(value)) == value
+    assert run.pack_value(LARGE_VALUE)[:1].isupper()  # compressed
+    assert not run.pack_value({'a': 1})[:1].isupper()
+
+def test_get_set_delete(make_cache):
+    cache = make_cache()
+    assert cache.get('missing', 'default') == 'default'
+    cache.set('key', LARGE_VALUE)
+    assert cache.get('key') == LARGE_VALUE
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.delete('key')
+    assert cache.get('key') is None
+    assert len(cache) == 0
+
+def test_expired_entries_are_kept_for_stale_reads(make_cache):
+    cache = make_cache(ttl=60)
+    cache.set('key', 'value')
+    cache.ttl = -1
+    cache.set('expired', 'old value')
+    assert cache.get('key') == 'value'
+    assert cache.get('expired') is None
+    assert cache.get_stale('expired') == 'old value'
+    assert cache.get_stale('missing', 'default') == 'default'
+
+def test_namespaces_are_separate(make_cache):
+    sessions, places = make_cache('session'), make_cache('place')
+    sessions.set('key', 'session value')
+    places.set('key', 'place value')
+    sessions.delete_prefix('')
+    assert sessions.get('key') is None
+    assert places.get('key') == 'place value'
+    assert len(places) == 1
+
+def test_delete_prefix_matches_literally(make_cache):
+    cache = make_cache()
+    keys = ['a_b:1', 'axb:1', 'a%b:1', 'a*b:1', 'a?b:1', 'a[b]:1', 'ab]:1', 'a\\b:1', 'a\\\\b:1']
+    for key in keys:
+        cache.set(key, key)
+    for prefix in ('a_b:', 'a%b:', 'a*b:', 'a?b:', 'a[b]:', 'a\\b:'):
+        cache.delete_prefix(prefix)
+        keys = [key for key in keys if not key.startswith(prefix)]
+        assert [key for key in keys if cache.get(key) == key] == keys, prefix
+    assert sorted(keys) == ['a\\\\b:1', 'ab]:1', 'axb:1']
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = run.TTLCache('test', 2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+
+def test_sqlite_cache_evicts_least_recently_used(sqlite_path, monkeypatch):
+    # Steps longer than CACHE_ACCESS_RESOLUTION, so every read records its access
+    ticks = itertools.count(1_000_000, run.CACHE_ACCESS_RESOLUTION)
+    monkeypatch.setattr(run.time, 'time', lambda: float(next(ticks)))
+    cache = run.SQLiteCache(sqlite_path, 'test', 2, 3600)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+
+def test_sqlite_cache_reads_rarely_write(sqlite_path, clock):
+    cache = run.SQLiteCache(sqlite_path, 'test', 10, 3600)
+    cache.set('key', 'value')
+    changes = cache._conn.total_changes
+    for _ in range(10):
+        assert cache.get('key') == 'value'
+    assert cache._conn.total_changes == changes
+
+def test_locked_sqlite_cache_drops_writes(sqlite_path, monkeypatch):
+    ticks = itertools.count(1_000_000, run.CACHE_ACCESS_RESOLUTION)
+    monkeypatch.setattr(run.time, 'time', lambda: float(next(ticks)))
+    cache = run.SQLiteCache(sqlite_path, 'test', 10, 3600)
+    cache.set('key', 'value')
+    cache._conn.execute('PRAGMA busy_timeout = 0')
+    # Another process holding the write lock
+    other = run.sqlite3.connect(sqlite_path)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        assert cache.get('key') == 'value'  # the access time is not recorded
+        cache.set('other', 'value')
+        cache.delete('key')
+        cache.delete_prefix('')
+    finally:
+        other.rollback()
+        other.close()
+    assert cache.get('key') == 'value'
+    assert cache.get('other') is None
+
+def test_sqlite_cache_expires_by_ttl(sqlite_path, clock):
+    cache = run.SQLiteCache(sqlite_path, 'test', 10, 5)
+    cache.set('key', 'value')
+    assert cache.get('key') == 'value'
+    for _ in range(5):
+        run.time.time()
+    assert cache.get('key') is None
+    assert cache.get_stale('key') == 'value'
+
+def test_sqlite_cache_is_shared_between_instances(sqlite_path):
+    run.SQLiteCache(sqlite_path, 'test', 10, 60).set('key', LARGE_VALUE)
+    assert run.SQLiteCache(sqlite_path, 'test', 10, 60).get('key') == LARGE_VALUE
+
+def test_redis_cache_keys_expire_after_stale_retention(redis_server):
+    cache = redis_cache(redis_server, ttl=10)
+    cache.set('key', 'value')
+    assert 60 < cache.client.ttl('volund:test:key') <= 61
+
+def test_redis_cache_evicts_least_recently_used(redis_server, clock):
+    cache = redis_cache(redis_server, maxsize=2)
+    other = redis_cache(redis_server, namespace='other', maxsize=2)
+    other.set('a', 0)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert len(cache) == 2
+    assert other.get('a') == 0
+
+def test_redis_cache_deletes_drop_the_access_times(redis_server):
+    cache = redis_cache(redis_server)
+    for key in ('a:1', 'a:2', 'b:1'):
+        cache.set(key, key)
+    cache.delete('b:1')
+    cache.delete_prefix('a:')
+    assert cache.client.zcard(cache.index) == 0
+
+def test_redis_outage_is_a_miss(redis_server):
+    cache = redis_cache(redis_server)
+    cache.set('key', 'value')
+    redis_server.connected = False
+    assert cache.get('key', 'default') == 'default'
+    assert cache.get_stale('key') is None
+    cache.set('key', 'new value')
+    cache.delete('key')
+    cache.delete_prefix('')
+    assert len(cache) == 0
+    redis_server.connected = True
+    assert cache.get('key') == 'value'
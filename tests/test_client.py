@@ -0,0 +1,156 @@
+# Tests of the backend client policy: single-flight coalescing and the circuit breaker
+import threading
+import time
+
+import pytest
+
+import run
+
+# Function to start `count` threads calling single_flight.do with the same key at once; returns the
+# threads and the list their results (or exceptions) are appended to
+def call_concurrently(single_flight, count, fn):
+    outcomes = []
+    started = threading.Barrier(count)
+
+    def call():
+        started.wait()
+        try:
+            outcomes.append(single_flight.do('/endpoint', 'key', fn))
+        except Exception as e:
+            outcomes.append(e)
+
+    threads = [threading.Thread(target=call) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, outcomes
+
+# Function to wait until `count` calls have reached single_flight.do
+def wait_for_calls(single_flight, count):
+    deadline = time.monotonic() + 5
+    while sum(single_flight.executed.values()) + sum(single_flight.collapsed.values()) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_collapsed_calls_share_one_result():
+    single_flight = run.SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {'value': 42}
+
+    threads, outcomes = call_concurrently(single_flight, 4, fn)
+    wait_for_calls(single_flight, 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert outcomes == [{'value': 42}] * 4
+    assert outcomes[0] is outcomes[1]
+    assert (single_flight.executed['/endpoint'], single_flight.collapsed['/endpoint']) == (1, 3)
+
+def test_collapsed_calls_share_one_exception():
+    single_flight = run.SingleFlight()
+    release = threading.Event()
+    error = ValueError('backend down')
+
+    def fn():
+        release.wait(5)
+        raise error
+
+    threads, outcomes = call_concurrently(single_flight, 3, fn)
+    wait_for_calls(single_flight, 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert outcomes == [error] * 3
+
+def test_finished_calls_are_not_shared():
+    single_flight = run.SingleFlight()
+    results = iter([1, 2])
+    assert single_flight.do('/endpoint', 'key', lambda: next(results)) == 1
+    assert single_flight.do('/endpoint', 'key', lambda: next(results)) == 2
+    with pytest.raises(KeyError):
+        single_flight.do('/endpoint', 'key', lambda: {}['missing'])
+    assert single_flight.do('/endpoint', 'key', lambda: 3) == 3
+    assert single_flight.executed['/endpoint'] == 4
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(run.time, 'monotonic', lambda: now[0])
+    return now
+
+def test_breaker_opens_after_threshold(clock):
+    breaker = run.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(2):
+        breaker.record_failure()
+        assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+def test_breaker_success_resets_the_failure_count(clock):
+    breaker = run.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+
+def test_half_open_breaker_allows_one_trial(clock):
+    breaker = run.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+    assert breaker.state == 'half-open'
+    assert not breaker.allow()
+
+def test_half_open_trial_success_closes(clock):
+    breaker = run.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.allow()
+
+def test_half_open_trial_failure_reopens(clock):
+    breaker = run.CircuitBreaker(failure_threshold=5, reset_timeout=30)
+    for _ in range(5):
+        breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.retry_in() == 30
+
+# Session whose every request fails with `error`
+class FailingSession:
+    def __init__(self, error):
+        self.error = error
+
+    def request(self, method, url, **kwargs):
+        raise self.error
+
+@pytest.mark.parametrize('error', [
+    run.requests.exceptions.ConnectionError('refused'),
+    run.requests.exceptions.ChunkedEncodingError('cut off mid-body'),
+    run.requests.exceptions.ContentDecodingError('bad gzip'),
+])
+def test_failed_half_open_trial_call_reopens(monkeypatch, clock, error):
+    breaker = run.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    monkeypatch.setattr(run, 'get_circuit_breaker', lambda: breaker)
+    monkeypatch.setattr(run, 'get_http_session', lambda: FailingSession(error))
+    breaker.record_failure()
+    clock[0] += 30
+    with pytest.raises(type(error)):
+        run.send_request('POST', 'http://backend/query_ai')
+    assert breaker.state == 'open'
+    with pytest.raises(run.BackendUnavailable):
+        run.send_request('POST', 'http://backend/query_ai')
@@ -0,0 +1,64 @@
+# Tests of the local message store and the incremental (delta) session sync
+import sqlite3
+
+import pytest
+
+import run
+
+def message(index):
+    return {'query': f'question {index}', 'response': f'answer {index}'}
+
+@pytest.fixture
+def store(tmp_path):
+    return run.MessageStore(str(tmp_path / 'messages.sqlite3'), max_sessions=10)
+
+def test_full_response_replaces_the_local_copy(store):
+    store.save('s1', {'session_id': 's1'}, [message(0), message(1), message(2)])
+    details = run.merge_session_details(store, 's1', {'session_id': 's1', 'conversation': [message(9)]}, since=3)
+    assert details['conversation'] == [message(9)]
+    assert store.count('s1') == 1
+
+def test_delta_response_is_appended_after_since(store):
+    store.save('s1', {'session_id': 's1'}, [message(0), message(1)])
+    data = {'session_id': 's1', 'since': 2, 'conversation': [message(2), message(3)]}
+    details = run.merge_session_details(store, 's1', data, since=2)
+    assert details['conversation'] == [message(0), message(1), message(2), message(3)]
+    assert 'since' not in details
+
+def test_delta_response_replays_idempotently(store):
+    store.save('s1', {'session_id': 's1'}, [message(0)])
+    data = {'session_id': 's1', 'since': 1, 'conversation': [message(1)]}
+    run.merge_session_details(store, 's1', data, since=1)
+    details = run.merge_session_details(store, 's1', data, since=1)
+    assert details['conversation'] == [message(0), message(1)]
+
+def test_empty_delta_keeps_the_conversation(store):
+    store.save('s1', {'session_id': 's1'}, [message(0)])
+    data = {'session_id': 's1', 'title': 'Trip', 'since': 1, 'conversation': []}
+    details = run.merge_session_details(store, 's1', data, since=1)
+    assert details == {'session_id': 's1', 'title': 'Trip', 'conversation': [message(0)]}
+
+def test_least_recently_synced_sessions_are_evicted(tmp_path):
+    store = run.MessageStore(str(tmp_path / 'messages.sqlite3'), max_sessions=2)
+    for session_id in ('s1', 's2', 's3'):
+        store.save(session_id, {'session_id': session_id}, [message(0)])
+    assert store.load('s1') is None
+    assert store.count('s1') == 0
+    assert store.load('s3')['conversation'] == [message(0)]
+
+def test_store_created_before_eviction_is_migrated(tmp_path):
+    path = str(tmp_path / 'messages.sqlite3')
+    with sqlite3.connect(path) as connection:
+        connection.execute('CREATE TABLE sessions (session_id TEXT PRIMARY KEY, details TEXT NOT NULL)')
+        connection.execute("INSERT INTO sessions VALUES ('old', '{}')")
+    store = run.MessageStore(path, max_sessions=1)
+    store.save('new', {'session_id': 'new'}, [message(0)])
+    assert store.load('old') is None
+    assert store.load('new') is not None
+
+def test_first_queries_of_the_given_sessions(store):
+    store.save(5, {'session_id': 5}, [message(0), message(1)])
+    store.save('s2', {'session_id': 's2'}, [message(2)])
+    store.save('s3', {'session_id': 's3'}, [message(3)])
+    assert store.first_queries([5, 's2', 'missing']) == {'5': 'question 0', 's2': 'question 2'}
+    assert store.first_queries([]) == {}
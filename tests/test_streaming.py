@@ -0,0 +1,40 @@
+# Tests of the server-sent events parser behind streamed AI answers
+import run
+
+class FakeResponse:
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        return iter(self.chunks)
+
+def events(*chunks):
+    return list(run.iter_sse_data(FakeResponse(*chunks)))
+
+def test_one_event_per_blank_line():
+    assert events(b'data: one\n\ndata: two\n\n') == ['one', 'two']
+
+def test_crlf_line_endings():
+    assert events(b'data: one\r\n\r\ndata: two\r\n\r\n') == ['one', 'two']
+
+def test_multi_line_data_is_joined_with_newlines():
+    assert events(b'data: first line\ndata: second line\n\n') == ['first line\nsecond line']
+
+def test_events_split_across_chunks():
+    assert events(b'da', b'ta: {"token": "he', b'llo"}\r', b'\n\r\n') == ['{"token": "hello"}']
+
+def test_multi_byte_characters_split_across_chunks():
+    data = 'data: café 🏔\n\n'.encode()
+    assert events(data[:9], data[9:14], data[14:]) == ['café 🏔']
+
+def test_other_fields_and_comments_are_ignored():
+    assert events(b': keep-alive\nevent: token\nid: 3\ndata: value\n\n') == ['value']
+
+def test_blank_lines_without_data_yield_nothing():
+    assert events(b'\n\n: ping\n\n') == []
+
+def test_last_event_without_trailing_blank_line():
+    assert events(b'data: one\n\ndata: [DONE]\n') == ['one', '[DONE]']
+
+def test_data_without_space_after_colon():
+    assert events(b'data:tight\n\n') == ['tight']